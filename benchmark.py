@@ -0,0 +1,178 @@
+import argparse
+import concurrent.futures
+import json
+import platform
+import resource
+import time
+import tracemalloc
+import numpy as np
+import engine
+import inference
+import rover
+import simulate
+
+#-----------------------------------------------------------------------------
+# Benchmark harness for the inference paths.
+#
+# Every (grid size, sequence length, missing rate, inference path) case runs
+# in a fresh worker process, so that its peak RSS is not polluted by earlier
+# cases. A case is first timed on its own and then run once more under
+# tracemalloc to measure its peak traced memory and the number of memory
+# blocks its result still holds afterwards (a net count of blocks, not a
+# count of every allocation made along the way).
+
+PATHS = ['model_construction',
+         'forward_backward_python', 'viterbi_python',
+         'forward_backward_numpy', 'viterbi_numpy',
+         'forward_backward_checkpointed']
+
+def _run_path(path, grid, model, observations, prior_distribution):
+    if path == 'model_construction':
+        grid = rover.GridModel(grid.width, grid.height)
+        return engine.build_grid_model_arrays(grid)
+    if path.endswith('_python'):
+        inputs = (model.hidden_states, model.observed_states,
+                  prior_distribution, grid.transition_model,
+                  grid.observation_model, observations)
+        if path == 'forward_backward_python':
+            return inference.forward_backward(*inputs)
+        return inference.Viterbi(*inputs)
+
+    encoded = model.encode_observations(observations)
+    if path == 'forward_backward_numpy':
+        return engine.forward_backward(model, encoded)
+    if path == 'viterbi_numpy':
+        return engine.viterbi(model, encoded)
+    if path == 'forward_backward_checkpointed':
+        return engine.forward_backward(model, encoded, checkpoint_interval=0)
+    raise ValueError('unknown inference path %r' % (path,))
+
+def run_case(path, width, height, num_time_steps, missing_rate, repeat,
+             seed):
+    # runs one benchmark case and returns its record
+    grid  = rover.GridModel(width, height)
+    model = engine.build_grid_model_arrays(grid)
+    _, sampled = simulate.sample(model, 1, num_time_steps, missing_rate,
+                                 seed)
+    observations = [None if k == engine.MISSING else model.observed_states[k]
+                    for k in sampled[0].tolist()]
+    prior_distribution = model.to_distribution(model.prior)
+    if path.endswith('_python'):
+        # fill the model tables up front, as a long-running caller would
+        grid.model_tables()
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = _run_path(path, grid, model, observations,
+                           prior_distribution)
+        times.append(time.perf_counter() - start)
+        del result
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = _run_path(path, grid, model, observations, prior_distribution)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    result_blocks = sum(stat.count_diff for stat in
+                        after.compare_to(before, 'lineno'))
+    del result, before, after
+
+    best = min(times)
+    if path == 'model_construction' or best == 0:
+        steps_per_s = None
+    else:
+        steps_per_s = num_time_steps / best
+    return {'path': path,
+            'grid_width': width,
+            'grid_height': height,
+            'num_states': model.num_states,
+            'num_time_steps': num_time_steps,
+            'missing_rate': missing_rate,
+            'seed': seed,
+            'repeat': repeat,
+            'wall_time_s': best,
+            'mean_wall_time_s': sum(times) / len(times),
+            'steps_per_s': steps_per_s,
+            'baseline_rss_kb': baseline_rss,
+            'peak_rss_kb': peak_rss,
+            'traced_peak_bytes': traced_peak,
+            'result_blocks': result_blocks}
+
+def _grid_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+def _list_of(convert):
+    return lambda text: [convert(part) for part in text.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the inference paths and write the results '
+                    'as JSON.')
+    parser.add_argument('--grid-sizes', type=_list_of(_grid_size),
+                        default=[(12, 8), (50, 50)],
+                        help='comma-separated WxH grid sizes '
+                             '(default: 12x8,50x50)')
+    parser.add_argument('--lengths', type=_list_of(int), default=[100, 1000],
+                        help='comma-separated sequence lengths '
+                             '(default: 100,1000)')
+    parser.add_argument('--missing-rates', type=_list_of(float),
+                        default=[0., .2],
+                        help='comma-separated missing observation rates '
+                             '(default: 0,0.2)')
+    parser.add_argument('--paths', type=_list_of(str), default=PATHS,
+                        help='comma-separated inference paths, out of %s'
+                             % ','.join(PATHS))
+    parser.add_argument('--max-python-work', type=float, default=1e5,
+                        help='skip the python paths when states x steps '
+                             'exceeds this (default: %(default)g)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs per case (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='bench_output.json',
+                        help='JSON results file (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    for path in args.paths:
+        if path not in PATHS:
+            parser.error('unknown inference path %r' % (path,))
+
+    cases = []
+    for width, height in args.grid_sizes:
+        num_states = rover.GridModel(width, height).num_states
+        for num_time_steps in args.lengths:
+            for missing_rate in args.missing_rates:
+                for path in args.paths:
+                    if path.endswith('_python') and \
+                       num_states * num_time_steps > args.max_python_work:
+                        continue
+                    cases.append((path, width, height, num_time_steps,
+                                  missing_rate, args.repeat, args.seed))
+
+    results = []
+    for case in cases:
+        # one process per case keeps the peak RSS of each case separate
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            record = pool.submit(run_case, *case).result()
+        results.append(record)
+        if record['steps_per_s'] is None:
+            throughput = ''
+        else:
+            throughput = '%12.1f steps/s' % record['steps_per_s']
+        print('%-30s %4dx%-4d T=%-6d missing=%.2f %10.4fs %s'
+              % (record['path'], record['grid_width'], record['grid_height'],
+                 record['num_time_steps'], record['missing_rate'],
+                 record['wall_time_s'], throughput))
+
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'platform': platform.platform(),
+                   'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
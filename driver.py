@@ -0,0 +1,130 @@
+import argparse
+import concurrent.futures
+import glob
+import os
+import sys
+import numpy as np
+import engine
+import evaluate
+import rover
+
+#-----------------------------------------------------------------------------
+# Command-line driver that runs forward-backward and Viterbi over many
+# trajectory files in parallel and streams the error rates to a results file.
+#
+# The model arrays are built once in the parent process and handed to every
+# worker through the pool initializer, so the tasks themselves only carry a
+# file name.
+
+_worker_model = None
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+def find_trajectory_files(paths, pattern='*.txt'):
+    # expands directories (matching pattern inside them) and globs into a
+    # sorted list of files
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames.extend(glob.glob(os.path.join(path, pattern)))
+        elif glob.has_magic(path):
+            filenames.extend(glob.glob(path))
+        else:
+            filenames.append(path)
+    return sorted(set(filenames))
+
+def evaluate_file(filename, model=None):
+    """
+    Inputs
+    ------
+    filename: a trajectory file in the format read by rover.load_data()
+    model: the ModelArrays to run on; defaults to the one the worker was
+        started with
+
+    Output
+    ------
+    A tuple (filename, number of time steps, Viterbi error rate,
+    forward-backward error rate); raises ValueError if the observations are
+    impossible under the model
+    """
+    if model is None:
+        model = _worker_model
+    hidden_states, observations = rover.load_data(filename)
+    num_time_steps = len(hidden_states)
+    if num_time_steps == 0:
+        return filename, 0, float('nan'), float('nan')
+
+    encoded = model.encode_observations(observations)
+    truth   = evaluate.state_indices(model, hidden_states)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        marginals, log_normalizers = engine.forward_backward(
+            model, encoded, return_normalizers=True)
+    # an impossible sequence has no marginals to score
+    if not np.isfinite(log_normalizers.sum()):
+        raise ValueError('the observations are impossible under the model')
+
+    estimated_states = engine.viterbi(model, encoded)
+    viterbi_error    = evaluate.state_errors(truth, estimated_states).mean()
+    marginal_error   = evaluate.state_errors(
+        truth, evaluate.marginal_modes(marginals)).mean()
+    return filename, num_time_steps, viterbi_error, marginal_error
+
+def run(filenames, output, max_workers=None, model=None):
+    # evaluates the files on a process pool and writes one tab-separated line
+    # per file to output as soon as it completes; a file that fails gets a
+    # row of NaNs and its error goes to stderr. Returns the number of files
+    if model is None:
+        model = engine.rover_model_arrays()
+    output.write('file\tsteps\tviterbi_error\tforward_backward_error\n')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                initializer=_init_worker,
+                                                initargs=(model,)) as pool:
+        futures = {pool.submit(evaluate_file, filename): filename
+                   for filename in filenames}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                filename, num_time_steps, viterbi_error, marginal_error = \
+                    future.result()
+            except Exception as error:
+                filename = futures[future]
+                num_time_steps, viterbi_error, marginal_error = \
+                    0, float('nan'), float('nan')
+                sys.stderr.write('%s: %s: %s\n' % (filename,
+                                                    type(error).__name__,
+                                                    error))
+            output.write('%s\t%d\t%.4f\t%.4f\n' % (filename, num_time_steps,
+                                                   viterbi_error,
+                                                   marginal_error))
+            output.flush()
+    return len(futures)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run forward-backward and Viterbi over trajectory files '
+                    'in parallel.')
+    parser.add_argument('paths', nargs='+',
+                        help='trajectory files, directories or glob patterns')
+    parser.add_argument('--pattern', default='*.txt',
+                        help='file pattern used inside directories '
+                             '(default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: one per '
+                             'CPU)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='results file, or - for stdout (default)')
+    args = parser.parse_args(argv)
+
+    filenames = find_trajectory_files(args.paths, args.pattern)
+    if len(filenames) == 0:
+        parser.error('no trajectory files found')
+
+    if args.output == '-':
+        run(filenames, sys.stdout, args.workers)
+    else:
+        with open(args.output, 'w') as output:
+            run(filenames, output, args.workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,981 @@
+import functools
+import numpy as np
+import instrument
+import rover
+
+#-----------------------------------------------------------------------------
+# Array-backed inference engine.
+#
+# Hidden states are indexed once, in the order given by the list of all
+# possible hidden states, and observed states likewise.  Distributions become
+# float vectors over that index and an observation sequence becomes an int
+# vector of observation indices, where a missing observation is encoded as -1.
+
+MISSING = -1
+
+class SparseMatrix:
+    """
+    A minimal compressed sparse row (CSR) matrix.
+
+    Row r holds the entries data[indptr[r]:indptr[r+1]] in the columns
+    indices[indptr[r]:indptr[r+1]], sorted by column.
+
+    Methods
+    -------
+    dot(vector):
+      returns the product of the matrix with a vector, or with a matrix whose
+      first axis runs over the columns
+    transpose():
+      returns the transposed matrix, also in CSR form
+    padded_rows():
+      returns the rows as two equally wide arrays of columns and values
+    gather_rows(rows, data=None):
+      returns the entries of the given rows
+    """
+    def __init__(self, indptr, indices, data, shape):
+        self.indptr  = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data    = np.asarray(data, dtype=np.float64)
+        self.shape   = shape
+        # start offsets of the non-empty rows, which is what reduceat needs
+        self._nonempty = self.indptr[:-1] < self.indptr[1:]
+        self._starts   = self.indptr[:-1][self._nonempty]
+        self._padded   = None
+
+    @classmethod
+    def from_triplets(cls, rows, columns, values, shape):
+        rows    = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        values  = np.asarray(values, dtype=np.float64)
+        order   = np.lexsort((columns, rows))
+        counts  = np.bincount(rows, minlength=shape[0])
+        indptr  = np.concatenate(([0], np.cumsum(counts)))
+        return cls(indptr, columns[order], values[order], shape)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def row_ids(self):
+        # the row of every stored entry
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def dot(self, vector):
+        vector   = np.asarray(vector)
+        if vector.ndim > 1 and self._padded_layout() is not None:
+            # one pass per slot of the padded rows, each over whole
+            # contiguous rows of vector, beats a reduceat over the first axis
+            columns, values = self._padded
+            values = values.reshape(values.shape + (1,) * (vector.ndim - 1))
+            result = values[:, 0] * vector[columns[:, 0]]
+            for slot in range(1, columns.shape[1]):
+                result += values[:, slot] * vector[columns[:, slot]]
+            return result
+        products = vector[self.indices]
+        if vector.ndim == 1:
+            products = products * self.data
+        else:
+            products = products * self.data.reshape((-1,) + (1,) * (vector.ndim - 1))
+        result = np.zeros((self.shape[0],) + vector.shape[1:])
+        if self.nnz > 0:
+            result[self._nonempty] = np.add.reduceat(products, self._starts,
+                                                     axis=0)
+        return result
+
+    def _padded_layout(self):
+        # the padded rows, unless padding would more than quadruple the
+        # entries (e.g. a few very long rows)
+        if self._padded is None:
+            counts = np.diff(self.indptr)
+            if self.nnz > 0 and counts.max() * self.shape[0] <= 4 * self.nnz:
+                self._padded = self.padded_rows()
+            else:
+                self._padded = False
+        return self._padded or None
+
+    def transpose(self):
+        return SparseMatrix.from_triplets(self.indices, self.row_ids(),
+                                          self.data,
+                                          (self.shape[1], self.shape[0]))
+
+    def gather_rows(self, rows, data=None):
+        # the entries of the given rows, as three vectors: the position in
+        # rows that each entry belongs to, its column and its value; data
+        # may replace the stored values with another vector aligned to them
+        if data is None:
+            data = self.data
+        rows    = np.asarray(rows, dtype=np.int64)
+        starts  = self.indptr[rows]
+        counts  = self.indptr[rows + 1] - starts
+        owners  = np.repeat(np.arange(len(rows)), counts)
+        entries = np.repeat(starts - (np.cumsum(counts) - counts), counts) + \
+                  np.arange(counts.sum())
+        return owners, self.indices[entries], data[entries]
+
+    def padded_rows(self, fill_value=0.):
+        # rows padded to the longest row; padding points at column 0 and
+        # holds fill_value
+        counts  = np.diff(self.indptr)
+        width   = int(counts.max()) if len(counts) > 0 else 0
+        columns = np.zeros((self.shape[0], width), dtype=np.int64)
+        values  = np.full((self.shape[0], width), fill_value)
+        slots   = np.arange(self.nnz) - np.repeat(self.indptr[:-1], counts)
+        columns[self.row_ids(), slots] = self.indices
+        values[self.row_ids(), slots]  = self.data
+        return columns, values
+
+class ModelArrays:
+    """
+    Array encoding of the rover HMM.
+
+    Attributes
+    ----------
+    hidden_states: list of hidden states, hidden_states[i] has index i
+    state_index: dict mapping each hidden state to its index
+    observed_states: list of observed states, observed_states[k] has index k
+    observation_index: dict mapping each observed state to its index
+    prior: vector of prior probabilities over hidden states
+    transitions: SparseMatrix with transitions[i, j] = p(next = j | current = i)
+    transitions_t: the transpose of transitions, used by the forward pass
+    emissions: SparseMatrix with emissions[i, k] = p(observation k | state i)
+    emissions_t: the transpose of emissions, whose row k lists the states
+      that can produce observation k
+
+    Methods
+    -------
+    log_arrays():
+      returns the log prior and the predecessor lists with their log
+      transition probabilities, computed once and then cached
+    positions(), action_codes():
+      return the x and y coordinate vectors of the hidden states, and the
+      index of their action in rover.ACTIONS, cached
+    observed_positions():
+      returns the x and y coordinate vectors of the observed states, cached
+    state_lookup(), observation_lookup():
+      return arrays mapping [x, y, action code] to the hidden state index
+      (-1 where there is none) and [x, y] to the observation index (MISSING
+      where there is none), cached
+    likelihood(observation_index), likelihoods(observation_indices):
+      return p(observation | state) for every state as a vector, or as a
+      |Z| x N matrix for N observations
+    likelihood_at(observation_index, states):
+      returns p(observation | state) for the given states only
+    to_array_distribution(vector), to_distribution(vector):
+      wrap a vector over hidden states as a rover.ArrayDistribution, or copy
+      its non-zero entries into a rover.Distribution
+    """
+    def __init__(self, hidden_states, observed_states, prior, transitions,
+                 emissions):
+        self.hidden_states     = list(hidden_states)
+        self.state_index       = {z: i for i, z in enumerate(self.hidden_states)}
+        self.observed_states   = list(observed_states)
+        self.observation_index = {o: k for k, o in enumerate(self.observed_states)}
+        self.prior             = prior
+        self.transitions       = transitions
+        self.transitions_t     = transitions.transpose()
+        self.emissions         = emissions
+        self.emissions_t       = emissions.transpose()
+        self._log_arrays       = None
+        self._positions        = None
+        self._action_codes     = None
+        self._observed_positions = None
+        self._state_lookup     = None
+        self._observation_lookup = None
+
+    @property
+    def num_states(self):
+        return len(self.hidden_states)
+
+    def log_arrays(self):
+        if self._log_arrays is None:
+            with np.errstate(divide='ignore'):
+                predecessors, log_transitions = \
+                    self.transitions_t.padded_rows(fill_value=0.)
+                log_transitions = np.log(log_transitions)
+                self._log_arrays = (np.log(self.prior), predecessors,
+                                    log_transitions)
+        return self._log_arrays
+
+    def positions(self):
+        # the x and y coordinates of every hidden state, as int vectors
+        if self._positions is None:
+            self._positions = (
+                np.array([z[0] for z in self.hidden_states], dtype=np.int64),
+                np.array([z[1] for z in self.hidden_states], dtype=np.int64))
+        return self._positions
+
+    def action_codes(self):
+        # the position of the action of every hidden state in rover.ACTIONS
+        if self._action_codes is None:
+            codes = {action: a for a, action in enumerate(rover.ACTIONS)}
+            self._action_codes = np.array([codes[z[2]]
+                                           for z in self.hidden_states],
+                                          dtype=np.int64)
+        return self._action_codes
+
+    def state_lookup(self):
+        if self._state_lookup is None:
+            xs, ys = self.positions()
+            lookup = np.full((xs.max(initial=-1) + 1, ys.max(initial=-1) + 1,
+                              len(rover.ACTIONS)), -1, dtype=np.int64)
+            lookup[xs, ys, self.action_codes()] = np.arange(self.num_states)
+            self._state_lookup = lookup
+        return self._state_lookup
+
+    def observed_positions(self):
+        if self._observed_positions is None:
+            observed = np.array(self.observed_states,
+                                dtype=np.int64).reshape(-1, 2)
+            self._observed_positions = (observed[:, 0].copy(),
+                                        observed[:, 1].copy())
+        return self._observed_positions
+
+    def observation_lookup(self):
+        if self._observation_lookup is None:
+            xs, ys = self.observed_positions()
+            lookup = np.full((xs.max(initial=-1) + 1, ys.max(initial=-1) + 1),
+                             MISSING, dtype=np.int64)
+            lookup[xs, ys] = np.arange(len(xs))
+            self._observation_lookup = lookup
+        return self._observation_lookup
+
+    def likelihood(self, observation_index):
+        # p(observation | state) for every state; all ones when missing
+        if observation_index == MISSING:
+            return np.ones(self.num_states)
+        start, end = self.emissions_t.indptr[observation_index:
+                                             observation_index+2]
+        likelihood = np.zeros(self.num_states)
+        likelihood[self.emissions_t.indices[start:end]] = \
+            self.emissions_t.data[start:end]
+        return likelihood
+
+    def likelihoods(self, observation_indices):
+        observation_indices = np.asarray(observation_indices)
+        likelihoods = np.zeros((self.num_states, len(observation_indices)))
+        likelihoods[:, observation_indices == MISSING] = 1.
+
+        # scatter row k of emissions_t into every column that observed k
+        present = np.flatnonzero(observation_indices != MISSING)
+        owners, states, values = \
+            self.emissions_t.gather_rows(observation_indices[present])
+        likelihoods[states, present[owners]] = values
+        return likelihoods
+
+    def likelihood_at(self, observation_index, states):
+        # p(observation | state) for a sorted vector of states only
+        if observation_index == MISSING:
+            return np.ones(len(states))
+        start, end = self.emissions_t.indptr[observation_index:
+                                             observation_index+2]
+        support = self.emissions_t.indices[start:end]
+        if len(support) == 0:
+            return np.zeros(len(states))
+        positions = np.minimum(np.searchsorted(support, states),
+                               len(support) - 1)
+        return np.where(support[positions] == states,
+                        self.emissions_t.data[start:end][positions], 0.)
+
+    def encode_observations(self, observations):
+        # turn a list of observed states (or None) into an index vector
+        encoded = np.empty(len(observations), dtype=np.int64)
+        for i, observation in enumerate(observations):
+            if observation is None:
+                encoded[i] = MISSING
+            else:
+                encoded[i] = self.observation_index[observation]
+        return encoded
+
+    def to_array_distribution(self, vector):
+        # wrap a vector over hidden states, without copying it, into a
+        # rover.ArrayDistribution that shares this model's state index
+        return rover.ArrayDistribution(self.hidden_states, self.state_index,
+                                       vector)
+
+    def to_distribution(self, vector):
+        # convert a vector over hidden states into a rover.Distribution that
+        # holds the non-zero entries, in hidden state order
+        distribution = rover.Distribution({})
+        nonzero = np.flatnonzero(vector)
+        for i, p in zip(nonzero.tolist(), vector[nonzero].tolist()):
+            distribution[self.hidden_states[i]] = p
+        return distribution
+
+    def from_distribution(self, distribution):
+        if isinstance(distribution, rover.ArrayDistribution) and \
+           distribution.states is self.hidden_states:
+            return distribution.vector.copy()
+        vector = np.zeros(self.num_states)
+        for z, p in distribution.items():
+            vector[self.state_index[z]] = p
+        return vector
+
+def build_model_arrays(all_possible_hidden_states,
+                       all_possible_observed_states,
+                       prior_distribution,
+                       transition_model,
+                       observation_model):
+    """
+    Inputs
+    ------
+    The model inputs of inference.forward_backward().
+
+    Output
+    ------
+    A ModelArrays, built by calling transition_model and observation_model
+    exactly once per hidden state
+    """
+    hidden_states     = list(all_possible_hidden_states)
+    observed_states   = list(all_possible_observed_states)
+    state_index       = {z: i for i, z in enumerate(hidden_states)}
+    observation_index = {o: k for k, o in enumerate(observed_states)}
+
+    prior = np.array([prior_distribution[z] for z in hidden_states],
+                     dtype=np.float64)
+
+    rows, columns, values = [], [], []
+    emission_rows, emission_columns, emission_values = [], [], []
+    for i, z in enumerate(hidden_states):
+        for next_z, p in transition_model(z).items():
+            if p != 0:
+                rows.append(i)
+                columns.append(state_index[next_z])
+                values.append(p)
+        for observation, p in observation_model(z).items():
+            if p != 0:
+                emission_rows.append(i)
+                emission_columns.append(observation_index[observation])
+                emission_values.append(p)
+
+    transitions = SparseMatrix.from_triplets(rows, columns, values,
+                                             (len(hidden_states),
+                                              len(hidden_states)))
+    emissions = SparseMatrix.from_triplets(emission_rows, emission_columns,
+                                           emission_values,
+                                           (len(hidden_states),
+                                            len(observed_states)))
+    return ModelArrays(hidden_states, observed_states, prior, transitions,
+                       emissions)
+
+def build_grid_model_arrays(grid):
+    # the ModelArrays of a rover.GridModel, built from its arrays without
+    # going through the per-state Distributions
+    shape = (grid.num_states, grid.num_states)
+    transitions = SparseMatrix(*grid.transition_arrays(), shape=shape)
+    emissions   = SparseMatrix(*grid.emission_arrays(),
+                               shape=(grid.num_states,
+                                      grid.width * grid.height))
+    model = ModelArrays(grid.hidden_states(), grid.observed_states(),
+                        grid.prior(), transitions, emissions)
+    model._positions = (grid.state_x.astype(np.int64),
+                        grid.state_y.astype(np.int64))
+    model._action_codes = grid.state_action.astype(np.int64)
+    return model
+
+@functools.lru_cache(maxsize=rover.MODEL_CACHE_SIZE)
+def _rover_model_arrays(grid_width, grid_height):
+    return build_grid_model_arrays(rover.grid_model())
+
+def rover_model_arrays():
+    # the ModelArrays of the rover model for the current grid size, built once
+    return _rover_model_arrays(rover.GRID_WIDTH, rover.GRID_HEIGHT)
+
+def clear_model_arrays():
+    # drops the cached rover model arrays; rover.clear_model_tables() calls
+    # this as well
+    _rover_model_arrays.cache_clear()
+
+rover._dependent_cache_clears.append(clear_model_arrays)
+
+def _record_message(recorder, name, time_step, message):
+    total = message.sum()
+    instrument.record_total(recorder, name, time_step, total)
+    recorder.support(name, time_step, int(np.count_nonzero(message)))
+    return total
+
+def _forward_step(model, forward_message, observation_index):
+    message = model.likelihood(observation_index) * \
+              model.transitions_t.dot(forward_message)
+    return message / message.sum()
+
+def _backward_step(model, backward_message, observation_index,
+                   recorder=None, time_step=None):
+    # observation_index is the observation at the step after the new message
+    message = model.transitions.dot(model.likelihood(observation_index) *
+                                    backward_message)
+    if recorder is not None:
+        return message / _record_message(recorder, 'backward', time_step,
+                                         message)
+    return message / message.sum()
+
+def forward_backward(model, observations, checkpoint_interval=None,
+                     return_normalizers=False):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observations: a vector of observation indices (MISSING when missing)
+    checkpoint_interval: if given, compute the marginals with
+        iter_marginals() instead of keeping every message in memory
+    return_normalizers: also return the log normalizers of the forward
+        messages, see log_normalizers()
+
+    Output
+    ------
+    A T x |Z| array whose i-th row is the marginal distribution at time step
+    i, or a tuple (marginals, log normalizers) with return_normalizers
+    """
+    num_time_steps = len(observations)
+    if checkpoint_interval is not None:
+        marginals = np.empty((num_time_steps, model.num_states))
+        for i, marginal in enumerate(iter_marginals(model, observations,
+                                                    checkpoint_interval)):
+            marginals[i] = marginal
+        if return_normalizers:
+            return marginals, log_normalizers(model, observations)
+        return marginals
+
+    recorder = instrument.active
+    forward_messages  = np.empty((num_time_steps, model.num_states))
+    backward_messages = np.empty((num_time_steps, model.num_states))
+    # normalizers[i] is the total of forward message i before scaling
+    normalizers = np.empty(num_time_steps)
+
+    with instrument.phase('forward'):
+        for i in range(num_time_steps):
+            if i == 0:
+                message = model.prior * model.likelihood(observations[0])
+            else:
+                message = model.likelihood(observations[i]) * \
+                          model.transitions_t.dot(forward_messages[i-1])
+            if recorder is not None:
+                normalizers[i] = _record_message(recorder, 'forward', i,
+                                                 message)
+            else:
+                normalizers[i] = message.sum()
+            forward_messages[i] = message / normalizers[i]
+
+    with instrument.phase('backward'):
+        backward_messages[num_time_steps-1] = 1. / model.num_states
+        for i in range(num_time_steps-2, -1, -1):
+            backward_messages[i] = _backward_step(model,
+                                                  backward_messages[i+1],
+                                                  observations[i+1],
+                                                  recorder, i)
+
+    with instrument.phase('marginals'):
+        marginals = forward_messages * backward_messages
+        marginals /= marginals.sum(axis=1, keepdims=True)
+    if return_normalizers:
+        with np.errstate(divide='ignore'):
+            return marginals, np.log(normalizers)
+    return marginals
+
+def log_normalizers(model, observations):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observations: a vector of observation indices (MISSING when missing)
+
+    Output
+    ------
+    A vector whose i-th entry is log p(observation i | observations before
+    i), the log of the factor the i-th forward message is scaled by. Its sum
+    is the log-likelihood of the observations. From the first impossible
+    observation on the entries are -inf. Only the running forward message is
+    kept in memory.
+    """
+    num_time_steps = len(observations)
+    normalizers = np.zeros(num_time_steps)
+    for i in range(num_time_steps):
+        if i == 0:
+            message = model.prior * model.likelihood(observations[0])
+        else:
+            message = model.likelihood(observations[i]) * \
+                      model.transitions_t.dot(message)
+        normalizers[i] = message.sum()
+        if normalizers[i] == 0:
+            break
+        message = message / normalizers[i]
+    with np.errstate(divide='ignore'):
+        return np.log(normalizers)
+
+def log_likelihood(model, observations):
+    # log p(observations), the sum of the log normalizers
+    return float(log_normalizers(model, observations).sum())
+
+def log_likelihood_batch(model, observations, lengths, block_size=64):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observations, lengths: padded observation indices and sequence lengths,
+        as returned by pad_observations()
+    block_size: number of sequences whose messages are propagated together;
+        blocks of a few dozen keep the |Z| x block_size messages in cache
+
+    Output
+    ------
+    A vector with the log-likelihood of each sequence (0 for an empty one,
+    -inf for an impossible one)
+    """
+    num_sequences, num_time_steps = observations.shape
+    lengths = np.asarray(lengths)
+    totals = np.zeros(num_sequences)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, num_sequences, block_size):
+            block = slice(start, start + block_size)
+            steps = int(lengths[block].max())
+            for i in range(steps):
+                if i == 0:
+                    message = model.prior[:, None] * \
+                              model.likelihoods(observations[block, 0])
+                else:
+                    message = model.likelihoods(observations[block, i]) * \
+                              model.transitions_t.dot(message)
+                normalizers = message.sum(axis=0)
+                totals[block] += np.where(i < lengths[block],
+                                          np.log(normalizers), 0.)
+                # an impossible sequence keeps a zero message, and so
+                # stays at -inf
+                message = message / np.where(normalizers > 0, normalizers, 1.)
+    return totals
+
+def iter_marginals(model, observations, checkpoint_interval=0):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observations: a vector of observation indices (MISSING when missing)
+    checkpoint_interval: number of time steps between stored messages;
+        0 picks about sqrt(T), which minimizes peak memory
+
+    Output
+    ------
+    A generator over the marginal distribution vectors at time steps
+    0, 1, ..., T-1, equal to the rows of forward_backward(). Only every
+    checkpoint_interval-th backward message is kept; the messages in between
+    are recomputed one segment at a time during the forward sweep, so that
+    at most O((T / checkpoint_interval + checkpoint_interval) |Z|) floats are
+    held at once.
+    """
+    num_time_steps = len(observations)
+    if num_time_steps == 0:
+        return
+    if not checkpoint_interval:
+        checkpoint_interval = max(1, int(np.ceil(np.sqrt(num_time_steps))))
+
+    # backward sweep, keeping the messages at the segment boundaries
+    checkpoints = {}
+    backward_message = np.full(model.num_states, 1. / model.num_states)
+    checkpoints[num_time_steps-1] = backward_message
+    for i in range(num_time_steps-2, 0, -1):
+        backward_message = _backward_step(model, backward_message,
+                                          observations[i+1])
+        if i % checkpoint_interval == 0:
+            checkpoints[i] = backward_message
+
+    # forward sweep, one segment [start, end) at a time
+    forward_message = None
+    for start in range(0, num_time_steps, checkpoint_interval):
+        end = min(start + checkpoint_interval, num_time_steps)
+        segment = [None] * (end - start)
+        if end == num_time_steps:
+            segment[-1] = np.full(model.num_states, 1. / model.num_states)
+        else:
+            segment[-1] = _backward_step(model, checkpoints.pop(end),
+                                         observations[end])
+        for i in range(end-2, start-1, -1):
+            segment[i-start] = _backward_step(model, segment[i-start+1],
+                                              observations[i+1])
+
+        for i in range(start, end):
+            if forward_message is None:
+                forward_message = model.prior * \
+                                  model.likelihood(observations[0])
+                forward_message = forward_message / forward_message.sum()
+            else:
+                forward_message = _forward_step(model, forward_message,
+                                                observations[i])
+            marginal = forward_message * segment[i-start]
+            segment[i-start] = None
+            yield marginal / marginal.sum()
+
+def viterbi(model, observations):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observations: a vector of observation indices (MISSING when missing)
+
+    Output
+    ------
+    A vector with the index of the estimated hidden state at each time step
+    """
+    log_prior, predecessors, log_transitions = model.log_arrays()
+    num_time_steps = len(observations)
+
+    def log_likelihood(observation_index):
+        with np.errstate(divide='ignore'):
+            return np.log(model.likelihood(observation_index))
+
+    recorder = instrument.active
+
+    # path_trellis[i, z] is the index of the best predecessor of z at time i
+    path_trellis = np.zeros((num_time_steps, model.num_states), dtype=np.int32)
+    with instrument.phase('viterbi'):
+        W = log_likelihood(observations[0]) + log_prior
+        for i in range(1, num_time_steps):
+            scores = log_transitions + W[predecessors]
+            best = scores.argmax(axis=1)
+            path_trellis[i] = predecessors[np.arange(model.num_states), best]
+            W = log_likelihood(observations[i]) + \
+                scores[np.arange(model.num_states), best]
+            if recorder is not None:
+                support = int(np.isfinite(W).sum())
+                recorder.support('viterbi', i, support)
+                if support == 0:
+                    recorder.event('underflow.viterbi', i, float(W.max()))
+
+    with instrument.phase('backtrack'):
+        estimated_hidden_states = np.empty(num_time_steps, dtype=np.int64)
+        estimated_hidden_states[num_time_steps-1] = W.argmax()
+        for i in range(num_time_steps-2, -1, -1):
+            estimated_hidden_states[i] = \
+                path_trellis[i+1, estimated_hidden_states[i+1]]
+    return estimated_hidden_states
+
+def viterbi_k_best(model, observations, k):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observations: a vector of observation indices (MISSING when missing)
+    k: the number of paths to return
+
+    Output
+    ------
+    A tuple (paths, scores): paths is an m x T array whose rows are the m <= k
+    most likely state index sequences, best first, and scores holds their
+    log joint probabilities log p(path, observations). m < k only when fewer
+    than k paths are possible.
+
+    This is the parallel list Viterbi algorithm. Every state keeps its k best
+    partial paths, sorted, as a |Z| x k score array. A state's new list is
+    the top k of the (predecessor, rank) candidates. The backpointers are a
+    single T x |Z| x k array of candidate slots, in the smallest integer type
+    that fits, so the cost is about k Viterbi passes.
+    """
+    log_prior, predecessors, log_transitions = model.log_arrays()
+    num_time_steps = len(observations)
+    num_states = model.num_states
+    width = predecessors.shape[1]
+
+    def log_likelihood(observation_index):
+        with np.errstate(divide='ignore'):
+            return np.log(model.likelihood(observation_index))
+
+    # path_trellis[i, z, r] is the slot p * k + q of the r-th best partial
+    # path into z at time i: it extends the q-th best path into
+    # predecessors[z, p]
+    path_trellis = np.zeros((num_time_steps, num_states, k),
+                            dtype=np.min_scalar_type(width * k - 1))
+    W = np.full((num_states, k), -np.inf)
+    W[:, 0] = log_likelihood(observations[0]) + log_prior
+    for i in range(1, num_time_steps):
+        # scores of every (predecessor, rank) candidate, |Z| x (width * k)
+        scores = (log_transitions[:, :, None] + W[predecessors]).reshape(
+            num_states, width * k)
+        # the k best candidates per state, ties going to the lower slot
+        best = np.argsort(-scores, axis=1, kind='stable')[:, :k]
+        path_trellis[i] = best
+        W = log_likelihood(observations[i])[:, None] + \
+            np.take_along_axis(scores, best, axis=1)
+
+    # the k best final (state, rank) pairs
+    final = np.argsort(-W.ravel(), kind='stable')[:k]
+    final = final[np.isfinite(W.ravel()[final])]
+    scores = W.ravel()[final]
+    paths = np.empty((len(final), num_time_steps), dtype=np.int64)
+    states, ranks = final // k, final % k
+    for i in range(num_time_steps-1, -1, -1):
+        paths[:, i] = states
+        if i > 0:
+            slots = path_trellis[i, states, ranks].astype(np.int64)
+            states, ranks = predecessors[states, slots // k], slots % k
+    return paths, scores
+
+def pad_observations(model, observation_sequences):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observation_sequences: a list of N observation lists, possibly of
+        different lengths
+
+    Output
+    ------
+    An N x T int array of observation indices, where T is the longest length
+    and the steps past the end of a sequence are MISSING, and a vector with
+    the length of each sequence
+    """
+    lengths = np.array([len(observations)
+                        for observations in observation_sequences],
+                       dtype=np.int64)
+    padded = np.full((len(observation_sequences),
+                      lengths.max() if len(lengths) > 0 else 0), MISSING,
+                     dtype=np.int64)
+    for n, observations in enumerate(observation_sequences):
+        padded[n, :lengths[n]] = model.encode_observations(observations)
+    return padded, lengths
+
+def forward_backward_batch(model, observations, lengths,
+                           return_normalizers=False):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observations, lengths: padded observation indices and sequence lengths,
+        as returned by pad_observations()
+    return_normalizers: also return the log normalizers of the forward
+        messages
+
+    Output
+    ------
+    An N x T x |Z| array of marginals; the rows past the end of a sequence
+    are zero. With return_normalizers, a tuple (marginals, log normalizers)
+    whose second entry is an N x T array laid out like log_normalizers() for
+    each sequence, with zeros past its end, so that its row sums are the
+    log-likelihoods
+    """
+    num_sequences, num_time_steps = observations.shape
+    # messages are kept as |Z| x N so that the sparse mat-vec runs over the
+    # first axis
+    forward_messages = np.empty((num_time_steps, model.num_states,
+                                 num_sequences))
+    normalizers = np.empty((num_time_steps, num_sequences))
+
+    message = model.prior[:, None] * model.likelihoods(observations[:, 0])
+    normalizers[0] = message.sum(axis=0)
+    forward_messages[0] = message / normalizers[0]
+    for i in range(1, num_time_steps):
+        message = model.likelihoods(observations[:, i]) * \
+                  model.transitions_t.dot(forward_messages[i-1])
+        normalizers[i] = message.sum(axis=0)
+        forward_messages[i] = message / normalizers[i]
+
+    marginals = np.zeros((num_sequences, num_time_steps, model.num_states))
+    uniform = np.full((model.num_states, num_sequences), 1. / model.num_states)
+    backward_message = uniform
+    for i in range(num_time_steps-1, -1, -1):
+        if i < num_time_steps-1:
+            message = model.transitions.dot(
+                model.likelihoods(observations[:, i+1]) * backward_message)
+            message /= message.sum(axis=0)
+            # sequences that end at or before step i restart from the
+            # initial backward message
+            backward_message = np.where(i >= lengths - 1, uniform, message)
+        marginal = forward_messages[i] * backward_message
+        marginal /= marginal.sum(axis=0)
+        marginals[:, i] = np.where(i < lengths, marginal, 0.).T
+    if return_normalizers:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_normalizers = np.log(normalizers.T)
+        # the messages of an impossible sequence are NaN after its first
+        # zero normalizer
+        log_normalizers[np.isnan(log_normalizers)] = -np.inf
+        log_normalizers[np.arange(num_time_steps) >=
+                        np.asarray(lengths)[:, None]] = 0.
+        return marginals, log_normalizers
+    return marginals
+
+def viterbi_batch(model, observations, lengths):
+    """
+    Inputs
+    ------
+    See forward_backward_batch().
+
+    Output
+    ------
+    An N x T array with the index of the estimated hidden state at each time
+    step; the entries past the end of a sequence are -1
+    """
+    log_prior, predecessors, log_transitions = model.log_arrays()
+    num_sequences, num_time_steps = observations.shape
+
+    def log_likelihoods(observation_indices):
+        with np.errstate(divide='ignore'):
+            return np.log(model.likelihoods(observation_indices)).T
+    rows = np.arange(model.num_states)
+
+    path_trellis = np.zeros((num_sequences, num_time_steps, model.num_states),
+                            dtype=np.int32)
+    W = log_likelihoods(observations[:, 0]) + log_prior
+    final_W = np.where((lengths == 1)[:, None], W, 0.)
+    for i in range(1, num_time_steps):
+        scores = log_transitions + W[:, predecessors]
+        best = scores.argmax(axis=2)
+        path_trellis[:, i] = predecessors[rows, best]
+        W = log_likelihoods(observations[:, i]) + \
+            np.take_along_axis(scores, best[:, :, None], axis=2)[:, :, 0]
+        final_W = np.where((lengths == i+1)[:, None], W, final_W)
+
+    sequences = np.arange(num_sequences)
+    estimated_hidden_states = np.full((num_sequences, num_time_steps), -1,
+                                      dtype=np.int64)
+    ends = lengths > 0
+    estimated_hidden_states[sequences[ends], lengths[ends]-1] = \
+        final_W[ends].argmax(axis=1)
+    for i in range(num_time_steps-2, -1, -1):
+        inside = i < lengths - 1
+        following = estimated_hidden_states[inside, i+1]
+        estimated_hidden_states[inside, i] = \
+            path_trellis[sequences[inside], i+1, following]
+    return estimated_hidden_states
+
+def _prune(values, top_k, epsilon):
+    # positions (sorted) of the entries of a normalized vector that survive
+    # the beam: at most top_k of them, and no more than the smallest set of
+    # largest entries that holds 1 - epsilon of the mass; also returns the
+    # mass of the entries that do not survive
+    order = np.argsort(-values, kind='stable')
+    keep  = len(values)
+    if top_k is not None:
+        keep = min(keep, top_k)
+    if epsilon is not None:
+        cumulative = np.cumsum(values[order])
+        keep = min(keep, int(np.searchsorted(cumulative, 1 - epsilon)) + 1)
+    return np.sort(order[:keep]), values[order[keep:]].sum()
+
+def _beam_step(states, values, top_k, epsilon, time_step):
+    # drops the zero entries, normalizes and prunes a sparse message;
+    # returns the kept states and values and the discarded mass
+    nonzero = values > 0
+    states, values = states[nonzero], values[nonzero]
+    if len(states) == 0:
+        raise ValueError('every state in the beam became impossible at time '
+                         'step %d; widen the beam' % time_step)
+    values = values / values.sum()
+    keep, discarded = _prune(values, top_k, epsilon)
+    values = values[keep]
+    return states[keep], values / values.sum(), discarded
+
+def forward_backward_beam(model, observations, top_k=None, epsilon=None):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observations: a vector of observation indices (MISSING when missing)
+    top_k: keep at most this many states per time step
+    epsilon: keep only the smallest set of states that holds 1 - epsilon of
+        the forward message
+
+    Output
+    ------
+    A list with one (states, probabilities) pair of vectors per time step,
+    giving the approximate marginal on its support, and a vector with the
+    forward message mass discarded at each time step. Messages are stored
+    and updated on their support only, so a step costs O(beam * degree)
+    rather than O(|Z|).
+    """
+    num_time_steps = len(observations)
+    supports  = [None] * num_time_steps
+    forward_messages = [None] * num_time_steps
+    discarded = np.zeros(num_time_steps)
+
+    states = np.flatnonzero(model.prior)
+    values = model.prior[states] * model.likelihood_at(observations[0],
+                                                       states)
+    supports[0], forward_messages[0], discarded[0] = \
+        _beam_step(states, values, top_k, epsilon, 0)
+    for i in range(1, num_time_steps):
+        owners, columns, values = model.transitions.gather_rows(supports[i-1])
+        states, inverse = np.unique(columns, return_inverse=True)
+        values = np.bincount(inverse, weights=values *
+                             forward_messages[i-1][owners],
+                             minlength=len(states))
+        values *= model.likelihood_at(observations[i], states)
+        supports[i], forward_messages[i], discarded[i] = \
+            _beam_step(states, values, top_k, epsilon, i)
+
+    # the backward messages only matter on the support of the forward ones
+    marginals = [None] * num_time_steps
+    backward_message = np.full(len(supports[-1]), 1. / len(supports[-1]))
+    for i in range(num_time_steps-1, -1, -1):
+        if i < num_time_steps-1:
+            owners, columns, values = model.transitions.gather_rows(supports[i])
+            positions = np.minimum(np.searchsorted(supports[i+1], columns),
+                                   len(supports[i+1]) - 1)
+            inside = supports[i+1][positions] == columns
+            values = values * np.where(inside,
+                model.likelihood_at(observations[i+1], columns) *
+                backward_message[positions], 0.)
+            backward_message = np.bincount(owners, weights=values,
+                                           minlength=len(supports[i]))
+            backward_message /= backward_message.sum()
+        marginal = forward_messages[i] * backward_message
+        marginals[i] = (supports[i], marginal / marginal.sum())
+        forward_messages[i] = None
+    return marginals, discarded
+
+def viterbi_beam(model, observations, top_k=None, epsilon=None):
+    """
+    Inputs
+    ------
+    See forward_backward_beam(). For epsilon, the max-product scores of a
+    time step are normalized into a distribution.
+
+    Output
+    ------
+    A vector with the index of the estimated hidden state at each time step,
+    and a vector with the normalized score mass discarded at each time step
+    """
+    num_time_steps = len(observations)
+    discarded = np.zeros(num_time_steps)
+    log_transition_data = np.log(model.transitions.data)
+
+    def prune(states, W, time_step):
+        finite = np.isfinite(W)
+        states, W = states[finite], W[finite]
+        if len(states) == 0:
+            raise ValueError('every state in the beam became impossible at '
+                             'time step %d; widen the beam' % time_step)
+        mass = np.exp(W - W.max())
+        mass /= mass.sum()
+        keep, discarded[time_step] = _prune(mass, top_k, epsilon)
+        return states[keep], W[keep]
+
+    with np.errstate(divide='ignore'):
+        states = np.flatnonzero(model.prior)
+        W = np.log(model.likelihood_at(observations[0], states)) + \
+            np.log(model.prior[states])
+        states, W = prune(states, W, 0)
+
+        # path_trellis[i] holds the states kept at time i and the index of
+        # the best predecessor of each
+        path_trellis = [None] * num_time_steps
+        for i in range(1, num_time_steps):
+            owners, columns, log_transitions = \
+                model.transitions.gather_rows(states, log_transition_data)
+            scores = log_transitions + W[owners]
+            # best score per target, ties going to the lowest predecessor
+            order = np.lexsort((states[owners], -scores, columns))
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = columns[order][1:] != columns[order][:-1]
+            best = order[first]
+            next_states = columns[best]
+            W = np.log(model.likelihood_at(observations[i], next_states)) + \
+                scores[best]
+            previous = states[owners[best]]
+            states, W = prune(next_states, W, i)
+            path_trellis[i] = (states, previous[np.searchsorted(next_states,
+                                                                states)])
+
+    estimated_hidden_states = np.empty(num_time_steps, dtype=np.int64)
+    estimated_hidden_states[num_time_steps-1] = states[W.argmax()]
+    for i in range(num_time_steps-1, 0, -1):
+        kept_states, previous = path_trellis[i]
+        estimated_hidden_states[i-1] = previous[
+            np.searchsorted(kept_states, estimated_hidden_states[i])]
+    return estimated_hidden_states, discarded
@@ -0,0 +1,172 @@
+import numpy as np
+import rover
+
+#-----------------------------------------------------------------------------
+# Vectorized evaluation of estimated hidden state sequences.
+#
+# Ground truth and estimates are arrays of hidden state indices (see
+# engine.ModelArrays), either one trajectory as a length-T vector or N
+# trajectories as an N x T array. Steps past the end of a shorter trajectory
+# hold PADDING, as in the output of engine.viterbi_batch(), and are ignored.
+
+PADDING = -1
+
+def state_indices(model, states):
+    # the indices of a list of hidden states, PADDING for None
+    return np.array([PADDING if z is None else model.state_index[z]
+                     for z in states], dtype=np.int64)
+
+def _as_batch(indices):
+    return np.atleast_2d(np.asarray(indices, dtype=np.int64))
+
+def marginal_modes(marginals, lengths=None):
+    """
+    Inputs
+    ------
+    marginals: a T x |Z| or N x T x |Z| array of marginals
+    lengths: for a batch, the length of each sequence
+
+    Output
+    ------
+    The index of the most likely state at each time step, PADDING past the
+    end of a sequence
+    """
+    modes = np.asarray(marginals).argmax(axis=-1)
+    if lengths is not None:
+        past_end = np.arange(modes.shape[-1]) >= np.asarray(lengths)[:, None]
+        modes[past_end] = PADDING
+    return modes
+
+def state_errors(truth, estimates):
+    # N x T bool array, True where the estimated state is wrong
+    truth, estimates = _as_batch(truth), _as_batch(estimates)
+    return (truth != estimates) & (truth != PADDING)
+
+def position_distances(model, truth, estimates):
+    # N x T array of Manhattan distances between the true and estimated
+    # positions, 0 past the end of a sequence
+    truth, estimates = _as_batch(truth), _as_batch(estimates)
+    xs, ys = model.positions()
+    distances = np.abs(xs[truth] - xs[estimates]) + \
+                np.abs(ys[truth] - ys[estimates])
+    return np.where(truth != PADDING, distances, 0)
+
+def position_errors(model, truth, estimates):
+    # N x T bool array, True where the estimated position is wrong
+    return position_distances(model, truth, estimates) > 0
+
+def action_confusion(model, truth, estimates):
+    """
+    Inputs
+    ------
+    model: the engine.ModelArrays the indices refer to
+    truth, estimates: state indices, as described at the top of the module
+
+    Output
+    ------
+    An A x A count matrix over rover.ACTIONS, whose [a, b] entry counts the
+    steps whose true action is a and whose estimated action is b
+    """
+    truth, estimates = _as_batch(truth), _as_batch(estimates)
+    valid = truth != PADDING
+    codes = model.action_codes()
+    num_actions = len(rover.ACTIONS)
+    pairs = codes[truth[valid]] * num_actions + codes[estimates[valid]]
+    return np.bincount(pairs, minlength=num_actions**2).reshape(
+        num_actions, num_actions)
+
+def transition_violations(model, estimates):
+    """
+    Inputs
+    ------
+    model: the engine.ModelArrays the indices refer to
+    estimates: state indices, as described at the top of the module
+
+    Output
+    ------
+    An N x T bool array, True at the steps whose estimated state cannot
+    follow the estimated state of the step before (or, at step 0, has zero
+    prior probability), i.e. lies outside the support of the transition
+    model
+    """
+    estimates = _as_batch(estimates)
+    transitions = model.transitions
+    # the non-zero entries as sorted keys row * |Z| + column
+    supported = transitions.row_ids() * model.num_states + \
+                transitions.indices
+    supported = supported[transitions.data != 0]
+
+    violations = np.zeros(estimates.shape, dtype=bool)
+    valid = estimates != PADDING
+    violations[:, 0] = valid[:, 0] & (model.prior[estimates[:, 0]] == 0)
+    if estimates.shape[1] > 1:
+        keys = estimates[:, :-1] * model.num_states + estimates[:, 1:]
+        found = np.minimum(np.searchsorted(supported, keys),
+                           len(supported) - 1)
+        violations[:, 1:] = valid[:, 1:] & (supported[found] != keys)
+    return violations
+
+class Evaluation:
+    """
+    Aggregates evaluation counts over any number of trajectories, without
+    keeping the per-step results around.
+
+    Attributes
+    ----------
+    model: the engine.ModelArrays the indices refer to
+    num_trajectories, num_steps: the number of trajectories and of (valid)
+      time steps added so far
+    state_errors, position_errors, position_distance, violations: for each
+      estimator, the total number of wrong states, of wrong positions, the
+      summed Manhattan distance and the number of transition violations
+    confusion: for each estimator, the action_confusion() count matrix
+
+    Methods
+    -------
+    add(truth, **estimates):
+      adds a trajectory or a batch of them; each keyword names an estimator
+      (e.g. viterbi=..., forward_backward=...) and gives its estimates
+    summary():
+      returns a dict of rates per estimator
+    """
+    def __init__(self, model):
+        self.model             = model
+        self.num_trajectories  = 0
+        self.num_steps         = 0
+        self.state_errors      = {}
+        self.position_errors   = {}
+        self.position_distance = {}
+        self.violations        = {}
+        self.confusion         = {}
+
+    def add(self, truth, **estimates):
+        truth = _as_batch(truth)
+        self.num_trajectories += truth.shape[0]
+        self.num_steps        += int((truth != PADDING).sum())
+        for name, estimated in estimates.items():
+            estimated = _as_batch(estimated)
+            distances = position_distances(self.model, truth, estimated)
+            counts = (int(state_errors(truth, estimated).sum()),
+                      int((distances > 0).sum()),
+                      int(distances.sum()),
+                      int(transition_violations(self.model, estimated).sum()))
+            for totals, count in zip((self.state_errors, self.position_errors,
+                                      self.position_distance, self.violations),
+                                     counts):
+                totals[name] = totals.get(name, 0) + count
+            confusion = action_confusion(self.model, truth, estimated)
+            if name in self.confusion:
+                self.confusion[name] += confusion
+            else:
+                self.confusion[name] = confusion
+
+    def summary(self):
+        summary = {}
+        steps = max(self.num_steps, 1)
+        for name in self.state_errors:
+            summary[name] = {
+                'error_rate':          self.state_errors[name] / steps,
+                'position_error_rate': self.position_errors[name] / steps,
+                'mean_distance':       self.position_distance[name] / steps,
+                'violations':          self.violations[name]}
+        return summary
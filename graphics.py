@@ -1,15 +1,108 @@
 import tkinter as tk
 from rover import GRID_WIDTH, GRID_HEIGHT
 import math
+import os
+import struct
+import sys
+import zlib
+import numpy as np
+import rover
 
 CELL_WIDTH  = 25
 CELL_HEIGHT = 25
 PADDING     = 20
 
+# RGB values of the Tk colors used on the canvas, for exported frames
+COLORS = {'white':  (255, 255, 255),
+          'black':  (0, 0, 0),
+          'gray11': (28, 28, 28),
+          'gray80': (204, 204, 204),
+          'red3':   (205, 0, 0)}
+
+# heatmap level of a cell that is painted red because the estimate is missing
+MISSING_LEVEL = -1
+
+_GRAY_FILLS = ['#%02x%02x%02x' % (level, level, level) for level in range(256)]
+
+def heatmap_levels(marginals, estimated_positions=None):
+    """
+    Inputs
+    ------
+    marginals: a list of distributions over hidden states (or None), one per
+        frame
+    estimated_positions: optionally, the estimated hidden state of each
+        frame; a frame with neither a marginal nor an estimate is marked
+        MISSING_LEVEL, the way playback_positions paints it red
+
+    Output
+    ------
+    A T x GRID_HEIGHT x GRID_WIDTH int16 array with the gray level (0 is
+    black, 255 white) of every heatmap cell in every frame
+    """
+    num_cells = GRID_HEIGHT * GRID_WIDTH
+    levels = np.full((len(marginals), GRID_HEIGHT, GRID_WIDTH), 255,
+                     dtype=np.int16)
+    # cell of each state, per state list shared by ArrayDistributions
+    cells_by_states = {}
+    for i, marginal in enumerate(marginals):
+        if marginal is None:
+            if estimated_positions is not None and \
+               estimated_positions[i] is None:
+                levels[i] = MISSING_LEVEL
+            continue
+        if isinstance(marginal, rover.ArrayDistribution):
+            cells = cells_by_states.get(id(marginal.states))
+            if cells is None:
+                cells = np.array([z[1] * GRID_WIDTH + z[0]
+                                  for z in marginal.states], dtype=np.int64)
+                cells_by_states[id(marginal.states)] = cells
+            probabilities = marginal.vector
+        else:
+            items = marginal.items()
+            cells = np.array([z[1] * GRID_WIDTH + z[0] for z, _ in items],
+                             dtype=np.int64)
+            probabilities = np.array([p for _, p in items], dtype=float)
+        position_dist = np.bincount(cells, weights=probabilities,
+                                    minlength=num_cells)
+        levels[i] = 255 - (position_dist * 255).astype(np.int16).reshape(
+            GRID_HEIGHT, GRID_WIDTH)
+    return levels
+
+def _arrow_points(cx, cy, action):
+    # corners of the polygon that shows action on a rover centered at
+    # (cx, cy); None when there is no action to show
+    if action == 'stay':
+        return (cx - CELL_WIDTH/5., cy - CELL_WIDTH/5,
+                cx - CELL_WIDTH/5., cy + CELL_WIDTH/5,
+                cx + CELL_WIDTH/5., cy + CELL_WIDTH/5.,
+                cx + CELL_WIDTH/5., cy - CELL_WIDTH/5.)
+    elif action == 'left':
+        return (cx - CELL_WIDTH/4., cy,
+                cx - CELL_WIDTH/4., cy,
+                cx + CELL_WIDTH/8., cy - CELL_WIDTH/4.,
+                cx + CELL_WIDTH/8., cy + CELL_WIDTH/4.)
+    elif action == 'right':
+        return (cx + CELL_WIDTH/4., cy,
+                cx + CELL_WIDTH/4., cy,
+                cx - CELL_WIDTH/8., cy - CELL_WIDTH/4.,
+                cx - CELL_WIDTH/8., cy + CELL_WIDTH/4.)
+    elif action == 'up':
+        return (cx, cy - CELL_HEIGHT/4.,
+                cx, cy - CELL_HEIGHT/4.,
+                cx - CELL_WIDTH/4., cy + CELL_HEIGHT/8.,
+                cx + CELL_WIDTH/4., cy + CELL_HEIGHT/8.)
+    elif action == 'down':
+        return (cx, cy + CELL_HEIGHT/4.,
+                cx, cy + CELL_HEIGHT/4.,
+                cx - CELL_WIDTH/4., cy - CELL_HEIGHT/8.,
+                cx + CELL_WIDTH/4., cy - CELL_HEIGHT/8.)
+    return None
+
 class playback_positions(tk.Tk):
     
     def __init__(self, true_positions, observed_positions,
-                 estimated_positions, estimated_marginals, *args, **kwargs):
+                 estimated_positions, estimated_marginals, *args,
+                 delay=800, **kwargs):
         tk.Tk.__init__(self, *args, **kwargs)
         self.wm_title('Rover Demo')
         self.canvas = tk.Canvas(self,
@@ -78,8 +171,19 @@ class playback_positions(tk.Tk):
         self.time_label = tk.Label(self, textvariable = self.time_count)
         self.time_label.pack()
                     
-        self.redraw(true_positions, observed_positions, estimated_positions,
-                    estimated_marginals, 800, 0)
+
+        # the frames are stepped through by index; the heatmap colors of
+        # every frame are computed up front and only the cells whose color
+        # changes are reconfigured
+        self.true_positions      = true_positions
+        self.observed_positions  = observed_positions
+        self.estimated_positions = estimated_positions
+        self.levels = heatmap_levels(estimated_marginals, estimated_positions)
+        self._shown_levels = np.full((GRID_HEIGHT, GRID_WIDTH), 255,
+                                     dtype=np.int16)
+        self._marked_missing = {'rect_left': False, 'rect_middle': False}
+
+        self.redraw(delay, 0)
        
     def __move_rover(self, rover, rover_arrow, state, horizontal_offset=0):
         if len(state) == 2:
@@ -96,39 +200,12 @@ class playback_positions(tk.Tk):
 
         cx = (x1 + x2)/2.
         cy = (y1 + y2)/2.
-        if action is None:
+        points = _arrow_points(cx, cy, action)
+        if points is None:
             self.canvas.coords(rover_arrow, 0, 0, 0, 0, 0, 0,)
-        elif action == 'stay':
-            self.canvas.coords(rover_arrow,
-                               cx - CELL_WIDTH/5., cy - CELL_WIDTH/5,
-                               cx - CELL_WIDTH/5., cy + CELL_WIDTH/5,
-                               cx + CELL_WIDTH/5., cy + CELL_WIDTH/5.,
-                               cx + CELL_WIDTH/5., cy - CELL_WIDTH/5.)
-        elif action == 'left':
-            self.canvas.coords(rover_arrow,
-                               cx - CELL_WIDTH/4., cy,
-                               cx - CELL_WIDTH/4., cy,
-                               cx + CELL_WIDTH/8., cy - CELL_WIDTH/4.,
-                               cx + CELL_WIDTH/8., cy + CELL_WIDTH/4.)
-        elif action == 'right':
-            self.canvas.coords(rover_arrow,
-                               cx + CELL_WIDTH/4., cy,
-                               cx + CELL_WIDTH/4., cy,
-                               cx - CELL_WIDTH/8., cy - CELL_WIDTH/4.,
-                               cx - CELL_WIDTH/8., cy + CELL_WIDTH/4.)
-        elif action == 'up':
-            self.canvas.coords(rover_arrow,
-                               cx, cy - CELL_HEIGHT/4.,
-                               cx, cy - CELL_HEIGHT/4.,
-                               cx - CELL_WIDTH/4., cy + CELL_HEIGHT/8.,
-                               cx + CELL_WIDTH/4., cy + CELL_HEIGHT/8.)
-        elif action == 'down':
-            self.canvas.coords(rover_arrow,
-                               cx, cy + CELL_HEIGHT/4.,
-                               cx, cy + CELL_HEIGHT/4.,
-                               cx - CELL_WIDTH/4., cy - CELL_HEIGHT/8.,
-                               cx + CELL_WIDTH/4., cy - CELL_HEIGHT/8.)   
-            
+        else:
+            self.canvas.coords(rover_arrow, *points)
+
     def move_rover_left(self, state):
         self.__move_rover(self.rover_left, self.rover_left_arrow, state,
                           PADDING)
@@ -145,61 +222,215 @@ class playback_positions(tk.Tk):
         """
         Color the bottom map, based on the marginal distribution. 
         """
-        position_dist = {}
-        for x in range(GRID_WIDTH):
-            for y in range(GRID_HEIGHT):
-                position_dist[x, y] = 0.0
-
-        for state, prob in marginals.items():
-            position_dist[state[0], state[1]] += prob
-
-        for x in range(GRID_WIDTH):
-            for y in range(GRID_HEIGHT):
-                color = position_dist[x, y] * 255    
-                self.canvas.itemconfigure(self.rect_right[y, x], 
-                    fill='#%02x%02x%02x' % (255-int(color), 255-int(color), 255-int(color))) 
-                    
-    def redraw(self, true_positions, observed_positions, estimated_positions,
-               estimated_marginals, delay, time_step):
-        if len(true_positions) == 0:
-            pass
-            #self.destroy()
-        else:
-            self.canvas.itemconfig('rect_left', fill='white',
-                                   outline='gray11')
-            self.canvas.itemconfig('rect_middle', fill='white',
-                                   outline='gray11')
-            self.canvas.itemconfig('rect_right', fill='white',
-                                   outline='gray11')
-            self.time_count.set('Time Step '+ str(time_step))
-            
-            if true_positions[0] is not None:
-                self.move_rover_left(true_positions[0])
-            else:
-                self.move_rover_left((-10, -10)) # hide 
-                self.canvas.itemconfig('rect_left', fill='red3',
-                                       outline='gray11')
+        self.show_heatmap_levels(heatmap_levels([marginals])[0])
 
-            if observed_positions[0] is not None:
-                self.move_rover_middle(observed_positions[0])
+    def show_heatmap_levels(self, levels):
+        # reconfigures the heatmap cells whose level differs from the shown one
+        for row, column in np.argwhere(levels != self._shown_levels).tolist():
+            level = levels[row, column]
+            if level == MISSING_LEVEL:
+                fill = 'red3'
             else:
-                self.move_rover_middle((-10, -10))
-                self.canvas.itemconfig('rect_middle', fill='red3',
-                                       outline='gray11')
+                fill = _GRAY_FILLS[level]
+            self.canvas.itemconfigure(self.rect_right[row, column], fill=fill)
+        self._shown_levels = levels.copy()
 
-            if estimated_positions[0] is not None:
-                self.move_rover_right(estimated_positions[0])
-            else:
-                self.move_rover_right((-10, -10))
-                self.canvas.itemconfig('rect_right', fill='red3',
-                                       outline='gray11')
-
-            if estimated_marginals[0] is not None:
-                self.color_heatmap_grid(estimated_marginals[0])
-
-            self.after(delay,
-                       lambda: self.redraw(true_positions[1:],
-                                           observed_positions[1:],
-                                           estimated_positions[1:],
-                                           estimated_marginals[1:],
-                                           delay, time_step+1))
\ No newline at end of file
+    def __mark_missing(self, tag, missing):
+        if self._marked_missing[tag] != missing:
+            self.canvas.itemconfig(tag, fill='red3' if missing else 'white')
+            self._marked_missing[tag] = missing
+
+    def redraw(self, delay, time_step):
+        if time_step >= len(self.true_positions):
+            return
+        self.time_count.set('Time Step '+ str(time_step))
+
+        true_position = self.true_positions[time_step]
+        self.__mark_missing('rect_left', true_position is None)
+        if true_position is not None:
+            self.move_rover_left(true_position)
+        else:
+            self.move_rover_left((-10, -10)) # hide
+
+        observed_position = self.observed_positions[time_step]
+        self.__mark_missing('rect_middle', observed_position is None)
+        if observed_position is not None:
+            self.move_rover_middle(observed_position)
+        else:
+            self.move_rover_middle((-10, -10))
+
+        estimated_position = self.estimated_positions[time_step]
+        if estimated_position is not None:
+            self.move_rover_right(estimated_position)
+        else:
+            self.move_rover_right((-10, -10))
+        self.show_heatmap_levels(self.levels[time_step])
+
+        self.after(delay, lambda: self.redraw(delay, time_step+1))
+
+#-----------------------------------------------------------------------------
+# Headless frame export
+#
+# render_frame() draws the same three panels as playback_positions into an
+# RGB array, without Tk, so that long runs can be rendered to image files on
+# machines without a display.
+
+def _panel_origins():
+    # left edge of the true, observed and estimated panels
+    return (PADDING,
+            GRID_WIDTH*CELL_WIDTH + PADDING*2,
+            GRID_WIDTH*CELL_WIDTH*2 + PADDING*3)
+
+def _fill_polygon(image, points, color):
+    # fills a convex polygon given as a flat (x, y, x, y, ...) tuple
+    xs = np.array(points[0::2])
+    ys = np.array(points[1::2])
+    x_lo, x_hi = int(math.floor(xs.min())), int(math.ceil(xs.max()))
+    y_lo, y_hi = int(math.floor(ys.min())), int(math.ceil(ys.max()))
+    py, px = np.mgrid[y_lo:y_hi, x_lo:x_hi] + .5
+    positive = np.ones(px.shape, dtype=bool)
+    negative = np.ones(px.shape, dtype=bool)
+    for i in range(len(xs)):
+        x1, y1 = xs[i], ys[i]
+        x2, y2 = xs[(i+1) % len(xs)], ys[(i+1) % len(xs)]
+        if x1 == x2 and y1 == y2:
+            continue
+        cross = (x2 - x1) * (py - y1) - (y2 - y1) * (px - x1)
+        positive &= cross >= 0
+        negative &= cross <= 0
+    image[y_lo:y_hi, x_lo:x_hi][positive | negative] = color
+
+def _draw_rover(image, state, horizontal_offset):
+    if len(state) == 2:
+        x, y   = state
+        action = None
+    else:
+        x, y, action = state
+    x1 = x * CELL_WIDTH + horizontal_offset
+    y1 = y * CELL_HEIGHT
+    cx = x1 + CELL_WIDTH/2.
+    cy = y1 + CELL_HEIGHT/2.
+
+    py, px = np.mgrid[y1:y1 + CELL_HEIGHT, x1:x1 + CELL_WIDTH] + .5
+    inside = ((px - cx) / (CELL_WIDTH/2. - 2))**2 + \
+             ((py - cy) / (CELL_HEIGHT/2. - 2))**2 <= 1
+    image[y1:y1 + CELL_HEIGHT, x1:x1 + CELL_WIDTH][inside] = COLORS['gray80']
+
+    points = _arrow_points(cx, cy, action)
+    if points is not None:
+        _fill_polygon(image, points, COLORS['black'])
+
+def render_frame(true_position, observed_position, estimated_position,
+                 levels):
+    """
+    Inputs
+    ------
+    true_position, observed_position, estimated_position: the states shown
+        on the three panels, None when missing
+    levels: the GRID_HEIGHT x GRID_WIDTH heatmap levels of the frame, as
+        returned by heatmap_levels()
+
+    Output
+    ------
+    The frame as a height x width x 3 uint8 RGB array, laid out like the
+    playback_positions canvas (without the text labels)
+    """
+    width  = GRID_WIDTH*CELL_WIDTH*3 + PADDING*4
+    height = GRID_HEIGHT*CELL_HEIGHT + PADDING*2
+    image  = np.full((height, width, 3), 255, dtype=np.uint8)
+
+    grid_height, grid_width = GRID_HEIGHT*CELL_HEIGHT, GRID_WIDTH*CELL_WIDTH
+    colors = np.empty((GRID_HEIGHT, GRID_WIDTH, 3), dtype=np.uint8)
+    red    = np.array(COLORS['red3'], dtype=np.uint8)
+    panels = zip(_panel_origins(),
+                 (true_position, observed_position, estimated_position))
+    for panel, (origin, position) in enumerate(panels):
+        if panel < 2:
+            colors[:] = COLORS['red3'] if position is None else COLORS['white']
+        else:
+            gray = np.clip(levels, 0, 255).astype(np.uint8)
+            colors[:] = gray[:, :, None]
+            colors[levels == MISSING_LEVEL] = red
+        cells = image[:grid_height, origin:origin + grid_width]
+        cells[:] = np.repeat(np.repeat(colors, CELL_HEIGHT, axis=0),
+                             CELL_WIDTH, axis=1)
+        cells[::CELL_HEIGHT, :] = COLORS['gray11']
+        cells[:, ::CELL_WIDTH]  = COLORS['gray11']
+        image[grid_height, origin:origin + grid_width + 1] = COLORS['gray11']
+        image[:grid_height + 1, origin + grid_width] = COLORS['gray11']
+        if position is not None:
+            _draw_rover(image, position, origin)
+    return image
+
+def write_png(filename, image):
+    # writes an RGB uint8 array as an 8-bit truecolor PNG
+    height, width, _ = image.shape
+    scanlines = np.concatenate([np.zeros((height, 1), dtype=np.uint8),
+                                image.reshape(height, width * 3)], axis=1)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + \
+               struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    with open(filename, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                           8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(scanlines.tobytes(), 6)))
+        f.write(chunk(b'IEND', b''))
+
+def write_ppm(filename, image):
+    # writes an RGB uint8 array as a binary PPM
+    height, width, _ = image.shape
+    with open(filename, 'wb') as f:
+        f.write(b'P6 %d %d 255\n' % (width, height))
+        f.write(image.tobytes())
+
+def export_frames(true_positions, observed_positions, estimated_positions,
+                  estimated_marginals, directory, image_format='png'):
+    """
+    Inputs
+    ------
+    true_positions, observed_positions, estimated_positions,
+    estimated_marginals: the same lists that playback_positions takes
+    directory: where to write the frames, created if needed
+    image_format: 'png' or 'ppm'
+
+    Output
+    ------
+    The list of written file names, frame_000000.png, frame_000001.png, ...
+    in time order
+    """
+    writers = {'png': write_png, 'ppm': write_ppm}
+    if image_format not in writers:
+        raise ValueError('unknown image format %r' % (image_format,))
+    os.makedirs(directory, exist_ok=True)
+
+    levels = heatmap_levels(estimated_marginals, estimated_positions)
+    filenames = []
+    for i in range(len(true_positions)):
+        image = render_frame(true_positions[i], observed_positions[i],
+                             estimated_positions[i], levels[i])
+        filename = os.path.join(directory,
+                                'frame_%06d.%s' % (i, image_format))
+        writers[image_format](filename, image)
+        filenames.append(filename)
+    return filenames
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4):
+        sys.exit('usage: python graphics.py <trajectory file> <output dir> '
+                 '[png|ppm]')
+    import engine
+    model = engine.rover_model_arrays()
+    hidden_states, observations = rover.load_data(sys.argv[1])
+    encoded = model.encode_observations(observations)
+    marginals = engine.forward_backward(model, encoded)
+    estimated_states = [model.hidden_states[i]
+                        for i in engine.viterbi(model, encoded)]
+    filenames = export_frames(hidden_states, observations, estimated_states,
+                              [model.to_array_distribution(marginal)
+                               for marginal in marginals],
+                              sys.argv[2],
+                              sys.argv[3] if len(sys.argv) == 4 else 'png')
+    print('wrote %d frames to %s' % (len(filenames), sys.argv[2]))
@@ -1,14 +1,61 @@
 import numpy as np
 import graphics
 import rover
+import engine as _engine
+import instrument as _instrument
+import evaluate
+import posterior
 import sys 
 
+def adjacency_index(all_possible_hidden_states,
+                    transition_model,
+                    observation_model):
+    """
+    Inputs
+    ------
+    See the list inputs for the function forward_backward() below.
+
+    Output
+    ------
+    A tuple (position, successors, predecessors, observation_support):
+    position maps each hidden state to its place in
+    all_possible_hidden_states; successors[z] and predecessors[z] list the
+    (state, transition probability) pairs with non-zero probability of
+    going from z, and to z, respectively; observation_support maps each
+    observation to a dict of the states that can produce it, with their
+    observation probabilities. Every list and dict is in the order of
+    all_possible_hidden_states.
+    """
+    position = {}
+    successors = {}
+    predecessors = {}
+    observation_support = {}
+    for i, z in enumerate(all_possible_hidden_states):
+        position[z] = i
+        predecessors[z] = []
+    for z in all_possible_hidden_states:
+        successors[z] = sorted([(next_z, p) for next_z, p in transition_model(z).items() if p != 0],
+                               key=lambda item: position[item[0]])
+        for next_z, p in successors[z]:
+            predecessors[next_z].append((z, p))
+        for observation, p in observation_model(z).items():
+            if p != 0:
+                observation_support.setdefault(observation, {})[z] = p
+    return position, successors, predecessors, observation_support
+
+def _record_distribution(recorder, name, time_step, distribution):
+    # reports a message Distribution that is about to be renormalized
+    _instrument.record_total(recorder, name, time_step,
+                             sum(distribution.values()))
+    recorder.support(name, time_step, len(distribution))
+
 def forward_backward(all_possible_hidden_states,
                      all_possible_observed_states,
                      prior_distribution,
                      transition_model,
                      observation_model,
-                     observations):
+                     observations,
+                     engine='python'):
     """
     Inputs
     ------
@@ -22,6 +69,12 @@ def forward_backward(all_possible_hidden_states,
         Distribution for the observation from that hidden state
     observations: a list of observations, one per hidden state
         (a missing observation is encoded as None)
+    engine: 'python' to pass messages as Distribution dicts, or 'numpy' to
+        run the array engine in engine.py on a sparse transition matrix and
+        return the marginals as rover.ArrayDistribution views of one
+        T x |Z| array.
+        The 'python' engine only visits the states that the previous
+        message can reach and that can produce the current observation.
 
     Output
     ------
@@ -29,7 +82,30 @@ def forward_backward(all_possible_hidden_states,
     should be encoded as a Distribution (see the Distribution class in
     rover.py), and the i-th Distribution should correspond to time
     step i
+
+    While an instrument.Recorder is active, the phases, model calls,
+    message support sizes and renormalizations are reported to it.
     """
+    recorder = _instrument.active
+    transition_model = _instrument.counted('transition_model', transition_model)
+    observation_model = _instrument.counted('observation_model', observation_model)
+
+    if engine == 'numpy':
+        with _instrument.phase('model'):
+            model = _engine.build_model_arrays(all_possible_hidden_states,
+                                               all_possible_observed_states,
+                                               prior_distribution,
+                                               transition_model,
+                                               observation_model)
+        marginals = _engine.forward_backward(model,
+                                             model.encode_observations(observations))
+        return [model.to_array_distribution(marginal) for marginal in marginals]
+    elif engine != 'python':
+        raise ValueError('unknown engine %r' % (engine,))
+
+    with _instrument.phase('model'):
+        position, successors, predecessors, observation_support = \
+            adjacency_index(all_possible_hidden_states, transition_model, observation_model)
 
     num_time_steps = len(observations)
     forward_messages = [None] * num_time_steps
@@ -37,127 +113,437 @@ def forward_backward(all_possible_hidden_states,
     backward_messages = [None] * num_time_steps
     marginals = [None] * num_time_steps 
     
-    # Initialization for forward message
-    forward_messages[0] = rover.Distribution({})
-    # populate the Distribution dict for all possible hidden states 
-    for z0 in all_possible_hidden_states:
-        prior_prob = prior_distribution[z0]
-        if observations[0] != None:
-            observation_prob = observation_model(z0)[observations[0]]
-        else:
-            observation_prob = 1
-        if prior_prob * observation_prob != 0:
-            forward_messages[0][z0] = prior_prob * observation_prob
-    forward_messages[0].renormalize()
-
-    # use recursive relationship to compute all forward messages 
-    for i in range(1, num_time_steps):
-        forward_messages[i] = rover.Distribution({})
-        for zi in all_possible_hidden_states:
-            if observations[i] != None:
-                observation_prob = observation_model(zi)[observations[i]]
+    with _instrument.phase('forward'):
+        # Initialization for forward message
+        forward_messages[0] = rover.Distribution({})
+        # populate the Distribution dict for all possible hidden states 
+        for z0 in all_possible_hidden_states:
+            prior_prob = prior_distribution[z0]
+            if observations[0] != None:
+                observation_prob = observation_model(z0)[observations[0]]
             else:
-                observation_prob = 1 
-            sum_of_prev_messages = 0
+                observation_prob = 1
+            if prior_prob * observation_prob != 0:
+                forward_messages[0][z0] = prior_prob * observation_prob
+        if recorder is not None:
+            _record_distribution(recorder, 'forward', 0, forward_messages[0])
+        forward_messages[0].renormalize()
+
+        # use recursive relationship to compute all forward messages 
+        for i in range(1, num_time_steps):
+            forward_messages[i] = rover.Distribution({})
+            # only states reachable from the previous message can get mass
+            reachable = set()
             for prev_z in forward_messages[i-1].keys():
-                sum_of_prev_messages += forward_messages[i-1][prev_z] * transition_model(prev_z)[zi]
-            if observation_prob * sum_of_prev_messages != 0:
-                forward_messages[i][zi] = observation_prob * sum_of_prev_messages
-        forward_messages[i].renormalize()
-    
-    # Initialization for backward messages 
-    backward_messages[num_time_steps-1] = rover.Distribution({})
-    for last_z in all_possible_hidden_states:
-        backward_messages[num_time_steps-1][last_z] = 1
-    
-    # use recursive relationship to compute all backward messages
-    for i in range(num_time_steps-2, -1, -1):
-        backward_messages[i] = rover.Distribution({})
-        for zi in all_possible_hidden_states:
-            sum_of_prev_messages = 0
-            for subsequent_z in backward_messages[i+1].keys():
-                if observations[i+1] != None:
-                    observation_prob = observation_model(subsequent_z)[observations[i+1]]
+                for next_z, _ in successors[prev_z]:
+                    reachable.add(next_z)
+            if observations[i] != None:
+                likelihoods = observation_support.get(observations[i], {})
+                candidates = [zi for zi in likelihoods if zi in reachable]
+            else:
+                likelihoods = None
+                candidates = sorted(reachable, key=position.get)
+            for zi in candidates:
+                if likelihoods is not None:
+                    observation_prob = likelihoods[zi]
                 else:
                     observation_prob = 1 
-                sum_of_prev_messages += backward_messages[i+1][subsequent_z] * observation_prob * transition_model(zi)[subsequent_z]
-            if sum_of_prev_messages != 0:
-                backward_messages[i][zi] = sum_of_prev_messages
-        backward_messages[i].renormalize()        
-
-    for i in range(num_time_steps):
-        marginals[i] = rover.Distribution({})
-        total_of_marginals = 0
-        for zi in all_possible_hidden_states:
-            total_of_marginals += forward_messages[i][zi] * backward_messages[i][zi]
-        for zi in all_possible_hidden_states:
-            if forward_messages[i][zi] * backward_messages[i][zi] != 0:
-                marginals[i][zi] = (forward_messages[i][zi] * backward_messages[i][zi]) / total_of_marginals
+                sum_of_prev_messages = 0
+                for prev_z, transition_prob in predecessors[zi]:
+                    if prev_z in forward_messages[i-1]:
+                        sum_of_prev_messages += forward_messages[i-1][prev_z] * transition_prob
+                if observation_prob * sum_of_prev_messages != 0:
+                    forward_messages[i][zi] = observation_prob * sum_of_prev_messages
+            if recorder is not None:
+                _record_distribution(recorder, 'forward', i, forward_messages[i])
+            forward_messages[i].renormalize()
+
+    with _instrument.phase('backward'):
+        # Initialization for backward messages 
+        backward_messages[num_time_steps-1] = rover.Distribution({})
+        for last_z in all_possible_hidden_states:
+            backward_messages[num_time_steps-1][last_z] = 1
+    
+        # use recursive relationship to compute all backward messages
+        for i in range(num_time_steps-2, -1, -1):
+            backward_messages[i] = rover.Distribution({})
+            if observations[i+1] != None:
+                likelihoods = observation_support.get(observations[i+1], {})
+                supported = [z for z in likelihoods if z in backward_messages[i+1]]
+            else:
+                likelihoods = None
+                supported = backward_messages[i+1].keys()
+            # only states that lead into the supported states can get mass
+            candidates = set()
+            for subsequent_z in supported:
+                for prev_z, _ in predecessors[subsequent_z]:
+                    candidates.add(prev_z)
+            for zi in sorted(candidates, key=position.get):
+                sum_of_prev_messages = 0
+                for subsequent_z, transition_prob in successors[zi]:
+                    if subsequent_z not in backward_messages[i+1]:
+                        continue
+                    if likelihoods is not None:
+                        observation_prob = likelihoods.get(subsequent_z, 0)
+                    else:
+                        observation_prob = 1 
+                    sum_of_prev_messages += backward_messages[i+1][subsequent_z] * observation_prob * transition_prob
+                if sum_of_prev_messages != 0:
+                    backward_messages[i][zi] = sum_of_prev_messages
+            if recorder is not None:
+                _record_distribution(recorder, 'backward', i, backward_messages[i])
+            backward_messages[i].renormalize()
+
+    with _instrument.phase('marginals'):
+        for i in range(num_time_steps):
+            marginals[i] = rover.Distribution({})
+            total_of_marginals = 0
+            for zi in forward_messages[i].keys():
+                total_of_marginals += forward_messages[i][zi] * backward_messages[i][zi]
+            for zi in forward_messages[i].keys():
+                if forward_messages[i][zi] * backward_messages[i][zi] != 0:
+                    marginals[i][zi] = (forward_messages[i][zi] * backward_messages[i][zi]) / total_of_marginals
 
     return marginals
 
+def iter_marginals(all_possible_hidden_states,
+                   all_possible_observed_states,
+                   prior_distribution,
+                   transition_model,
+                   observation_model,
+                   observations,
+                   checkpoint_interval=0):
+    """
+    Inputs
+    ------
+    See the list inputs for the function forward_backward() above.
+    checkpoint_interval: number of time steps between the messages that are
+        kept in memory; 0 picks about sqrt(T)
+
+    Output
+    ------
+    A generator over the same marginal distributions that forward_backward()
+    returns, in time order. Peak memory grows with sqrt(T) instead of T, at
+    the price of computing the backward messages twice.
+    """
+    model = _engine.build_model_arrays(all_possible_hidden_states,
+                                       all_possible_observed_states,
+                                       prior_distribution,
+                                       transition_model,
+                                       observation_model)
+    for marginal in _engine.iter_marginals(model,
+                                           model.encode_observations(observations),
+                                           checkpoint_interval):
+        yield model.to_array_distribution(marginal)
+
+def forward_backward_beam(all_possible_hidden_states,
+                          all_possible_observed_states,
+                          prior_distribution,
+                          transition_model,
+                          observation_model,
+                          observations,
+                          top_k=None,
+                          epsilon=None):
+    """
+    Inputs
+    ------
+    See the list inputs for the function forward_backward() above.
+    top_k: keep at most this many states per time step
+    epsilon: keep only the smallest set of states that holds 1 - epsilon of
+        the forward message at each time step
+
+    Output
+    ------
+    A list of approximate marginal distributions, like forward_backward(),
+    and a list with the probability mass discarded at each time step
+    """
+    model = _engine.build_model_arrays(all_possible_hidden_states,
+                                       all_possible_observed_states,
+                                       prior_distribution,
+                                       transition_model,
+                                       observation_model)
+    marginals, discarded = _engine.forward_backward_beam(model,
+                                                         model.encode_observations(observations),
+                                                         top_k, epsilon)
+    distributions = []
+    for states, probabilities in marginals:
+        distribution = rover.Distribution({})
+        for i, p in zip(states.tolist(), probabilities.tolist()):
+            distribution[model.hidden_states[i]] = p
+        distributions.append(distribution)
+    return distributions, discarded.tolist()
+
 def Viterbi(all_possible_hidden_states,
             all_possible_observed_states,
             prior_distribution,
             transition_model,
             observation_model,
-            observations):
+            observations,
+            engine='python'):
     """
     Inputs
     ------
-    See the list inputs for the function forward_backward() above.
+    See the list inputs for the function forward_backward() above. With
+    engine='numpy' the recursion runs in log space on precomputed arrays and
+    keeps its backpointers in a T x |Z| int32 array.
 
     Output
     ------
     A list of esitmated hidden states, each state is encoded as a tuple
     (<x>, <y>, <action>)
+
+    Reports to the active instrument.Recorder like forward_backward().
     """
+    recorder = _instrument.active
+    transition_model = _instrument.counted('transition_model', transition_model)
+    observation_model = _instrument.counted('observation_model', observation_model)
+
+    if engine == 'numpy':
+        with _instrument.phase('model'):
+            model = _engine.build_model_arrays(all_possible_hidden_states,
+                                               all_possible_observed_states,
+                                               prior_distribution,
+                                               transition_model,
+                                               observation_model)
+        path = _engine.viterbi(model, model.encode_observations(observations))
+        return [model.hidden_states[i] for i in path]
+    elif engine != 'python':
+        raise ValueError('unknown engine %r' % (engine,))
+
+    with _instrument.phase('model'):
+        position, successors, predecessors, observation_support = \
+            adjacency_index(all_possible_hidden_states, transition_model, observation_model)
+        log_predecessors = {}
+        for zi, prev_list in predecessors.items():
+            log_predecessors[zi] = [(prev_z, np.log(transition_prob))
+                                    for prev_z, transition_prob in prev_list]
 
     # initialization of the lists
     num_time_steps = len(observations)
     W = [None] * num_time_steps 
     estimated_hidden_states = [None] * num_time_steps
     path_trellis = [None] * num_time_steps
-    # initialization of the messages 
-    W[0] = rover.Distribution({})
-    for z0 in all_possible_hidden_states:
-        prior_prob = prior_distribution[z0]
-        if observations[0] != None:
-            observation_prob = observation_model(z0)[observations[0]]
-        else:
-            observation_prob = 1
-        if prior_prob !=0 and observation_prob !=0:
-            W[0][z0] = np.log(prior_prob) + np.log(observation_prob)
-    # recursion steps 
-    for i in range(1, num_time_steps):
-        W[i] = rover.Distribution({})
-        path_trellis[i] = {}
-        for zi in all_possible_hidden_states:
+    with _instrument.phase('viterbi'):
+        # initialization of the messages 
+        W[0] = rover.Distribution({})
+        for z0 in all_possible_hidden_states:
+            prior_prob = prior_distribution[z0]
+            if observations[0] != None:
+                observation_prob = observation_model(z0)[observations[0]]
+            else:
+                observation_prob = 1
+            if prior_prob !=0 and observation_prob !=0:
+                W[0][z0] = np.log(prior_prob) + np.log(observation_prob)
+        # recursion steps 
+        for i in range(1, num_time_steps):
+            W[i] = rover.Distribution({})
+            path_trellis[i] = {}
+            # states that cannot produce the observation never enter W[i]
             if observations[i] != None:
-                observation_prob = observation_model(zi)[observations[i]]
+                likelihoods = observation_support.get(observations[i], {})
+                candidates = likelihoods.keys()
             else:
-                observation_prob = 1 
-            max_prev_trans_prob = float('-inf')
-            for prev_z in W[i-1].keys():
-                if transition_model(prev_z)[zi] != 0:
-                    prev_trans_prob = np.log(transition_model(prev_z)[zi]) + W[i-1][prev_z]
-                    if prev_trans_prob > max_prev_trans_prob:
-                        max_prev_trans_prob = prev_trans_prob
-                        # remember the transition from which previous state is the most likely 
-                        path_trellis[i][zi] = prev_z
-            if observation_prob != 0:
-                W[i][zi] = np.log(observation_prob) + max_prev_trans_prob
-    
-    # obtain final prediction sequence
-    # obtain the final hidden state prediction
-    estimated_hidden_states[num_time_steps-1] = max(W[num_time_steps-1], key=W[num_time_steps-1].get)
-    # back track using the path trellis to find the rest of the predictions
-    for i in range(num_time_steps-2, -1, -1):
-        estimated_hidden_states[i] = path_trellis[i+1][estimated_hidden_states[i+1]]
+                likelihoods = None
+                candidates = all_possible_hidden_states
+            for zi in candidates:
+                if likelihoods is not None:
+                    observation_prob = likelihoods[zi]
+                else:
+                    observation_prob = 1 
+                max_prev_trans_prob = float('-inf')
+                for prev_z, log_transition_prob in log_predecessors[zi]:
+                    if prev_z in W[i-1]:
+                        prev_trans_prob = log_transition_prob + W[i-1][prev_z]
+                        if prev_trans_prob > max_prev_trans_prob:
+                            max_prev_trans_prob = prev_trans_prob
+                            # remember the transition from which previous state is the most likely 
+                            path_trellis[i][zi] = prev_z
+                if observation_prob != 0:
+                    W[i][zi] = np.log(observation_prob) + max_prev_trans_prob
+            if recorder is not None:
+                recorder.support('viterbi', i, len(W[i]))
+                if len(W[i]) == 0:
+                    recorder.event('underflow.viterbi', i, float('-inf'))
+
+    with _instrument.phase('backtrack'):
+        # obtain final prediction sequence
+        # obtain the final hidden state prediction
+        estimated_hidden_states[num_time_steps-1] = max(W[num_time_steps-1], key=W[num_time_steps-1].get)
+        # back track using the path trellis to find the rest of the predictions
+        for i in range(num_time_steps-2, -1, -1):
+            estimated_hidden_states[i] = path_trellis[i+1][estimated_hidden_states[i+1]]
 
     return estimated_hidden_states
 
 
+def Viterbi_beam(all_possible_hidden_states,
+                 all_possible_observed_states,
+                 prior_distribution,
+                 transition_model,
+                 observation_model,
+                 observations,
+                 top_k=None,
+                 epsilon=None):
+    """
+    Inputs
+    ------
+    See the list inputs for the function forward_backward_beam() above.
+
+    Output
+    ------
+    A list of estimated hidden states, like Viterbi(), and a list with the
+    normalized score mass discarded at each time step
+    """
+    model = _engine.build_model_arrays(all_possible_hidden_states,
+                                       all_possible_observed_states,
+                                       prior_distribution,
+                                       transition_model,
+                                       observation_model)
+    path, discarded = _engine.viterbi_beam(model,
+                                           model.encode_observations(observations),
+                                           top_k, epsilon)
+    return [model.hidden_states[i] for i in path], discarded.tolist()
+
+def Viterbi_k_best(all_possible_hidden_states,
+                   all_possible_observed_states,
+                   prior_distribution,
+                   transition_model,
+                   observation_model,
+                   observations,
+                   k):
+    """
+    Inputs
+    ------
+    See the list inputs for the function forward_backward() above.
+    k: the number of paths to return
+
+    Output
+    ------
+    A list of up to k pairs (estimated hidden states, log score), ranked from
+    the most likely path down. Each list of states is like the output of
+    Viterbi(), and the log score is log p(states, observations).
+    """
+    model = _engine.build_model_arrays(all_possible_hidden_states,
+                                       all_possible_observed_states,
+                                       prior_distribution,
+                                       transition_model,
+                                       observation_model)
+    paths, scores = _engine.viterbi_k_best(model,
+                                           model.encode_observations(observations),
+                                           k)
+    return [([model.hidden_states[i] for i in path], score)
+            for path, score in zip(paths.tolist(), scores.tolist())]
+
+def forward_backward_batch(all_possible_hidden_states,
+                           all_possible_observed_states,
+                           prior_distribution,
+                           transition_model,
+                           observation_model,
+                           observation_sequences):
+    """
+    Inputs
+    ------
+    See the list inputs for the function forward_backward() above, except
+    that observation_sequences is a list of observation lists, which may
+    have different lengths.
+
+    Output
+    ------
+    A list with, for each sequence, the list of marginal distributions that
+    forward_backward() returns for it. All sequences run together on the
+    array engine.
+    """
+    model = _engine.build_model_arrays(all_possible_hidden_states,
+                                       all_possible_observed_states,
+                                       prior_distribution,
+                                       transition_model,
+                                       observation_model)
+    observations, lengths = _engine.pad_observations(model,
+                                                     observation_sequences)
+    marginals = _engine.forward_backward_batch(model, observations, lengths)
+    return [[model.to_array_distribution(marginal)
+             for marginal in marginals[n, :lengths[n]]]
+            for n in range(len(observation_sequences))]
+
+def Viterbi_batch(all_possible_hidden_states,
+                  all_possible_observed_states,
+                  prior_distribution,
+                  transition_model,
+                  observation_model,
+                  observation_sequences):
+    """
+    Inputs
+    ------
+    See the list inputs for the function forward_backward_batch() above.
+
+    Output
+    ------
+    A list with, for each sequence, the list of estimated hidden states that
+    Viterbi() returns for it
+    """
+    model = _engine.build_model_arrays(all_possible_hidden_states,
+                                       all_possible_observed_states,
+                                       prior_distribution,
+                                       transition_model,
+                                       observation_model)
+    observations, lengths = _engine.pad_observations(model,
+                                                     observation_sequences)
+    paths = _engine.viterbi_batch(model, observations, lengths)
+    return [[model.hidden_states[i] for i in paths[n, :lengths[n]]]
+            for n in range(len(observation_sequences))]
+
+def log_likelihood(all_possible_hidden_states,
+                   all_possible_observed_states,
+                   prior_distribution,
+                   transition_model,
+                   observation_model,
+                   observations):
+    """
+    Inputs
+    ------
+    See the list inputs for the function forward_backward() above.
+
+    Output
+    ------
+    The log-likelihood log p(observations) of the observation sequence, -inf
+    if it is impossible. It is the sum of the logs of the factors the scaled
+    forward messages are normalized by, so it does not underflow on long or
+    unlikely sequences.
+    """
+    model = _engine.build_model_arrays(all_possible_hidden_states,
+                                       all_possible_observed_states,
+                                       prior_distribution,
+                                       transition_model,
+                                       observation_model)
+    return _engine.log_likelihood(model, model.encode_observations(observations))
+
+def log_likelihood_batch(all_possible_hidden_states,
+                         all_possible_observed_states,
+                         prior_distribution,
+                         transition_model,
+                         observation_model,
+                         observation_sequences):
+    """
+    Inputs
+    ------
+    See the list inputs for the function forward_backward_batch() above.
+
+    Output
+    ------
+    A list with the log-likelihood of each observation sequence, as
+    log_likelihood() computes it, with all sequences run together on the
+    array engine
+    """
+    model = _engine.build_model_arrays(all_possible_hidden_states,
+                                       all_possible_observed_states,
+                                       prior_distribution,
+                                       transition_model,
+                                       observation_model)
+    observations, lengths = _engine.pad_observations(model,
+                                                     observation_sequences)
+    return _engine.log_likelihood_batch(model, observations, lengths).tolist()
+
+
 if __name__ == '__main__':
    
     enable_graphics = True 
@@ -211,25 +597,26 @@ if __name__ == '__main__':
         print(estimated_states[time_step])
 
     # compute error probabilities 
-    correct = 0
-    for i in range(len(estimated_states)):
-        if estimated_states[i] == hidden_states[i]:
-            correct += 1 
-    print("Viterbi Error Probability = %.4f" %(1-correct/100)) 
-
-    correct = 0 
-    for i in range(len(marginals)):
-        z_pred = max(marginals[i], key=marginals[i].get)
-        if z_pred == hidden_states[i]:
-            correct += 1 
-    print("Forward-Backward Error Probability = %.4f" %(1-correct/100)) 
-
-    # search for possible violations, start off with a violation involving 'stay' action 
-    for i in range(1, len(marginals)):
-        z_pred = max(marginals[i], key=marginals[i].get)
-        prev_z_pred = max(marginals[i-1], key=marginals[i-1].get)
-        if z_pred[2] == 'stay' and (z_pred[0] != prev_z_pred[0] or z_pred[1] != prev_z_pred[1]):
-            print('Violation', i, prev_z_pred, z_pred)
+    model = _engine.build_model_arrays(all_possible_hidden_states,
+                                       all_possible_observed_states,
+                                       prior_distribution,
+                                       rover.transition_model,
+                                       rover.observation_model)
+    truth = evaluate.state_indices(model, hidden_states)
+    viterbi_states = evaluate.state_indices(model, estimated_states)
+    marginal_modes = evaluate.marginal_modes(posterior.marginal_array(model, marginals))
+    evaluation = evaluate.Evaluation(model)
+    evaluation.add(truth, viterbi=viterbi_states, forward_backward=marginal_modes)
+    summary = evaluation.summary()
+    print("Viterbi Error Probability = %.4f" %(summary['viterbi']['error_rate'])) 
+    print("Forward-Backward Error Probability = %.4f" %(summary['forward_backward']['error_rate'])) 
+
+    # search for possible violations: steps whose most likely state cannot
+    # follow the most likely state of the step before
+    violations = evaluate.transition_violations(model, marginal_modes)[0]
+    for i in np.flatnonzero(violations).tolist():
+        print('Violation', i, model.hidden_states[marginal_modes[i-1]] if i > 0 else None,
+              model.hidden_states[marginal_modes[i]])
 
     if enable_graphics:
         app = graphics.playback_positions(hidden_states,
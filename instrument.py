@@ -0,0 +1,138 @@
+import collections
+import contextlib
+import time
+
+#-----------------------------------------------------------------------------
+# Opt-in instrumentation for the inference engines.
+#
+# Nothing is recorded unless a Recorder is active, e.g.
+#
+#     with instrument.recording() as recorder:
+#         inference.forward_backward(...)
+#     print(recorder.metrics())
+#
+# While no Recorder is active every hook reduces to a check of the module
+# global `active`, done once per call or once per time step.
+
+# the Recorder that currently receives events, or None
+active = None
+
+# a message whose total falls below this before renormalization has
+# (nearly) underflowed
+UNDERFLOW_THRESHOLD = 1e-250
+
+class Recorder:
+    """
+    Collects the timings, counts and per-step measurements reported by the
+    inference engines.
+
+    Attributes
+    ----------
+    timers: total seconds spent in each phase
+    counters: number of times each counted event happened (model calls,
+      renormalizations, phases entered)
+    support_sizes: for each kind of message, a list of (time step, number of
+      states with non-zero mass)
+    events: a list of (name, time step, value) for numerical events, such as
+      an underflowing message total
+    callback: if given, called as callback(kind, name, value, time_step) on
+      every record, with kind one of 'phase', 'count', 'support' and 'event'
+
+    Methods
+    -------
+    phase(name): a context manager that times the enclosed block
+    count(name, n=1): adds n to a counter
+    support(name, time_step, size): records the support size of a message
+    event(name, time_step, value): records a numerical event
+    metrics(): returns a flat dict of numbers, for a metrics exporter
+    format_metrics(prefix='rover_'): returns the metrics in the Prometheus
+      text exposition format
+    """
+    def __init__(self, callback=None):
+        self.callback      = callback
+        self.timers        = collections.defaultdict(float)
+        self.counters      = collections.Counter()
+        self.support_sizes = collections.defaultdict(list)
+        self.events        = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timers[name] += elapsed
+            self.counters['phase.' + name] += 1
+            if self.callback is not None:
+                self.callback('phase', name, elapsed, None)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+        if self.callback is not None:
+            self.callback('count', name, n, None)
+
+    def support(self, name, time_step, size):
+        self.support_sizes[name].append((time_step, size))
+        if self.callback is not None:
+            self.callback('support', name, size, time_step)
+
+    def event(self, name, time_step, value):
+        self.events.append((name, time_step, value))
+        self.counters['event.' + name] += 1
+        if self.callback is not None:
+            self.callback('event', name, value, time_step)
+
+    def metrics(self):
+        metrics = {}
+        for name, seconds in self.timers.items():
+            metrics['seconds.' + name] = seconds
+        for name, n in self.counters.items():
+            metrics['count.' + name] = n
+        for name, sizes in self.support_sizes.items():
+            values = [size for _, size in sizes]
+            metrics['support.' + name + '.max']  = max(values)
+            metrics['support.' + name + '.mean'] = sum(values) / len(values)
+        return metrics
+
+    def format_metrics(self, prefix='rover_'):
+        lines = []
+        for name, value in sorted(self.metrics().items()):
+            lines.append('%s%s %r' % (prefix, name.replace('.', '_'), value))
+        return '\n'.join(lines) + '\n'
+
+@contextlib.contextmanager
+def recording(recorder=None, callback=None):
+    # activates recorder (a new one if None) for the enclosed block
+    global active
+    if recorder is None:
+        recorder = Recorder(callback)
+    previous = active
+    active = recorder
+    try:
+        yield recorder
+    finally:
+        active = previous
+
+def phase(name):
+    # times the enclosed block if a Recorder is active
+    if active is None:
+        return contextlib.nullcontext()
+    return active.phase(name)
+
+def counted(name, function):
+    # wraps function so that the active Recorder counts its calls; returns
+    # function itself when nothing is recording
+    recorder = active
+    if recorder is None:
+        return function
+    def wrapper(*args, **kwargs):
+        recorder.count(name)
+        return function(*args, **kwargs)
+    return wrapper
+
+def record_total(recorder, name, time_step, total):
+    # reports the total of a message about to be renormalized
+    recorder.count('renormalize.' + name)
+    if not total > UNDERFLOW_THRESHOLD:
+        recorder.event('underflow.' + name, time_step, total)
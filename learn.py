@@ -0,0 +1,354 @@
+import argparse
+import concurrent.futures
+import numpy as np
+import engine
+import rover
+
+#-----------------------------------------------------------------------------
+# Baum-Welch (EM) fitting of the rover model to unlabeled observation logs.
+#
+# The parameters are tied the way rover.GridModel ties them: one weight per
+# (previous action, next action) pair and one weight per sensor offset, each
+# renormalized over the moves or offsets that stay on the grid. The E-step
+# runs forward-backward on blocks of sequences at once and reduces the
+# expected transition and observation counts onto those weights; because of
+# the renormalization at the grid border the M-step has no closed form, so
+# it takes a few minorize-maximize steps, each of which increases the
+# likelihood.
+
+_worker_observations = None
+_worker_lengths      = None
+_worker_model        = None
+
+def _init_worker(observations, lengths):
+    global _worker_observations, _worker_lengths
+    _worker_observations = observations
+    _worker_lengths      = lengths
+
+def _parameters(grid):
+    # what a worker needs to rebuild grid
+    return (grid.width, grid.height, grid.radius, grid.transition_weights,
+            grid.sensor_weights)
+
+def _grid(parameters):
+    width, height, radius, transition_weights, sensor_weights = parameters
+    return rover.GridModel(width, height, radius,
+                           transition_weights=transition_weights,
+                           sensor_weights=sensor_weights)
+
+def expected_counts(grid, model, observations, lengths):
+    """
+    Inputs
+    ------
+    grid: the rover.GridModel of the current parameters
+    model: its engine.ModelArrays
+    observations, lengths: padded observation indices and sequence lengths,
+        as returned by engine.pad_observations()
+
+    Output
+    ------
+    A tuple (transition counts, offset counts, observed, log-likelihood,
+    impossible): the expected number of times each stored entry of
+    model.transitions is taken, the expected number of observations at each
+    sensor offset, the expected number of observations made from each hidden
+    state, the total log-likelihood of the sequences, and a bool vector that
+    marks the sequences with zero likelihood, which are left out of the
+    counts and the log-likelihood
+    """
+    num_sequences, num_time_steps = observations.shape
+    transitions = model.transitions
+    rows = transitions.row_ids()
+    columns = transitions.indices
+
+    offsets = grid.sensor_offsets()
+    r = int(np.floor(grid.radius))
+    side = 2 * r + 1
+    offset_codes = np.zeros(side * side, dtype=np.int64)
+    for j, (dx, dy) in enumerate(offsets):
+        offset_codes[(dx + r) * side + (dy + r)] = j
+    xs = grid.state_x.astype(np.int64)
+    ys = grid.state_y.astype(np.int64)
+
+    transition_counts = np.zeros(transitions.nnz)
+    offset_counts = np.zeros(len(offsets))
+    observed = np.zeros(model.num_states)
+    impossible = np.zeros(num_sequences, dtype=bool)
+
+    # forward messages, |Z| x N per time step; the messages of an impossible
+    # sequence become all zeros from its first impossible step on
+    forward_messages = np.empty((num_time_steps, model.num_states,
+                                 num_sequences))
+    normalizers = np.empty((num_time_steps, num_sequences))
+    for i in range(num_time_steps):
+        if i == 0:
+            message = model.prior[:, None] * \
+                      model.likelihoods(observations[:, 0])
+        else:
+            message = model.likelihoods(observations[:, i]) * \
+                      model.transitions_t.dot(forward_messages[i-1])
+        normalizers[i] = message.sum(axis=0)
+        impossible |= (normalizers[i] == 0) & (i < lengths)
+        forward_messages[i] = message / np.where(normalizers[i] > 0,
+                                                 normalizers[i], 1.)
+    valid = (np.arange(num_time_steps)[:, None] < lengths) & ~impossible
+    log_likelihood = np.log(normalizers[valid]).sum()
+
+    uniform = np.full((model.num_states, num_sequences), 1. / model.num_states)
+    backward_message = uniform
+    for i in range(num_time_steps-1, -1, -1):
+        if i < num_time_steps-1:
+            weighted = model.likelihoods(observations[:, i+1]) * \
+                       backward_message
+            predicted = transitions.dot(weighted)
+            # expected transitions from step i to i+1, for the sequences
+            # that reach step i+1
+            totals = (forward_messages[i] * predicted).sum(axis=0)
+            reached = (i + 1 < lengths) & ~impossible
+            weights = np.where(reached, 1. / np.where(reached, totals, 1.),
+                               0.)
+            transition_counts += transitions.data * np.einsum(
+                'en,en->e', forward_messages[i][rows],
+                weighted[columns] * weights)
+            sums = predicted.sum(axis=0)
+            message = predicted / np.where(sums > 0, sums, 1.)
+            backward_message = np.where((i >= lengths - 1) | impossible,
+                                        uniform, message)
+
+        present = (observations[:, i] != engine.MISSING) & (i < lengths) & \
+                  ~impossible
+        if not present.any():
+            continue
+        marginals = forward_messages[i][:, present] * \
+                    backward_message[:, present]
+        marginals /= marginals.sum(axis=0)
+        observed += marginals.sum(axis=1)
+        # the sensor offset between every state and each observation; the
+        # states out of sensor range have zero marginal probability
+        observed_x, observed_y = np.divmod(observations[present, i],
+                                           grid.height)
+        dx = observed_x[None, :] - xs[:, None]
+        dy = observed_y[None, :] - ys[:, None]
+        in_range = (np.abs(dx) <= r) & (np.abs(dy) <= r)
+        codes = offset_codes[np.where(in_range, (dx + r) * side + (dy + r), 0)]
+        offset_counts += np.bincount(codes.ravel(),
+                                     weights=np.where(in_range, marginals,
+                                                      0.).ravel(),
+                                     minlength=len(offsets))
+    return (transition_counts, offset_counts, observed, log_likelihood,
+            impossible)
+
+def _same_parameters(a, b):
+    return all(np.array_equal(x, y) for x, y in zip(a, b))
+
+def _block_counts(parameters, start, end, block_size):
+    # expected counts of the worker's sequences start:end, with the indices
+    # of the impossible ones in place of the bool vector; the model is
+    # rebuilt only when the parameters change
+    global _worker_model
+    if _worker_model is None or \
+       not _same_parameters(_worker_model[0], parameters):
+        grid = _grid(parameters)
+        _worker_model = (parameters, grid, engine.build_grid_model_arrays(grid))
+    _, grid, model = _worker_model
+
+    counts = None
+    for block in range(start, end, block_size):
+        block_end = min(block + block_size, end)
+        lengths = _worker_lengths[block:block_end]
+        observations = _worker_observations[block:block_end,
+                                            :max(int(lengths.max()), 1)]
+        block_counts = list(expected_counts(grid, model, observations,
+                                            lengths))
+        block_counts[-1] = block + np.flatnonzero(block_counts[-1])
+        if counts is None:
+            counts = block_counts
+        else:
+            for k in range(len(counts) - 1):
+                counts[k] = counts[k] + block_counts[k]
+            counts[-1] = np.concatenate([counts[-1], block_counts[-1]])
+    return counts
+
+def _maximize(weights, counts, exposure, feasible, groups, iterations=20):
+    """
+    Inputs
+    ------
+    weights: G x C current weights, one row per group of tied parameters
+    counts: G x C expected number of times each category was drawn
+    exposure: the expected number of draws from each of R rows
+    feasible: R x C bool array of the categories each row can draw
+    groups: the group of each row
+
+    Output
+    ------
+    The G x C weights after the given number of minorize-maximize steps on
+    the expected log-likelihood, in which row r draws category c with
+    probability weights[groups[r], c] over its sum across the feasible
+    categories of r. Each row of weights sums to 1.
+    """
+    num_groups, num_categories = weights.shape
+    weights = weights / weights.sum(axis=1, keepdims=True)
+    for _ in range(iterations):
+        totals = (feasible * weights[groups]).sum(axis=1)
+        share = np.where(totals > 0, exposure / np.where(totals > 0, totals,
+                                                         1.), 0.)
+        denominators = np.stack([np.bincount(groups,
+                                             weights=feasible[:, c] * share,
+                                             minlength=num_groups)
+                                 for c in range(num_categories)], axis=1)
+        weights = np.where(denominators > 0,
+                           counts / np.where(denominators > 0, denominators,
+                                             1.),
+                           weights)
+        weights = weights / weights.sum(axis=1, keepdims=True)
+    return weights
+
+def maximize(grid, model, transition_counts, offset_counts, observed):
+    # the GridModel whose tied parameters maximize the expected counts
+    num_actions = len(rover.ACTIONS)
+    actions = grid.state_action.astype(np.int64)
+    rows = model.transitions.row_ids()
+    columns = model.transitions.indices
+
+    pairs = np.bincount(actions[rows] * num_actions + actions[columns],
+                        weights=transition_counts,
+                        minlength=num_actions**2).reshape(num_actions,
+                                                          num_actions)
+    exits = np.bincount(rows, weights=transition_counts,
+                        minlength=model.num_states)
+    x, y = grid.state_x, grid.state_y
+    feasible = np.ones((model.num_states, num_actions), dtype=bool)
+    for code, dx, dy in rover._MOVES:
+        feasible[:, code] = (x + dx >= 0) & (x + dx < grid.width) & \
+                            (y + dy >= 0) & (y + dy < grid.height)
+    transition_weights = _maximize(grid.transition_weights, pairs, exits,
+                                   feasible, actions)
+
+    sensor_feasible = np.stack([(x + dx >= 0) & (x + dx < grid.width) &
+                                (y + dy >= 0) & (y + dy < grid.height)
+                                for dx, dy in grid.sensor_offsets()], axis=1)
+    sensor_weights = _maximize(grid.sensor_weights[None, :],
+                               offset_counts[None, :], observed,
+                               sensor_feasible,
+                               np.zeros(model.num_states, dtype=np.int64))[0]
+    return rover.GridModel(grid.width, grid.height, grid.radius,
+                           transition_weights=transition_weights,
+                           sensor_weights=sensor_weights)
+
+def baum_welch(observation_sequences, grid=None, iterations=20,
+               tolerance=1e-6, max_workers=1, block_size=16):
+    """
+    Inputs
+    ------
+    observation_sequences: a list of observation lists ((x, y) or None)
+    grid: the rover.GridModel to start from; defaults to rover.grid_model()
+    iterations: the largest number of EM iterations
+    tolerance: stop once an iteration raises the log-likelihood by less
+        than this much per observed time step
+    max_workers: number of worker processes for the E-step; 1 runs it in
+        this process
+    block_size: number of sequences whose forward-backward passes run
+        together
+
+    Output
+    ------
+    A tuple (grid, log-likelihoods): the fitted rover.GridModel, and the
+    log-likelihood of the sequences under the model of every iteration,
+    starting with the initial one. Raises ValueError, naming them by their
+    position in observation_sequences, if any sequences are impossible
+    under the model of an iteration. The grid plugs into the inference
+    functions as grid.hidden_states(), grid.observed_states(),
+    grid.initial_distribution(), grid.transition_model and
+    grid.observation_model, or into the array engine through
+    engine.build_grid_model_arrays(grid).
+    """
+    if grid is None:
+        grid = rover.grid_model()
+    model = engine.build_grid_model_arrays(grid)
+    observations, lengths = engine.pad_observations(model,
+                                                    observation_sequences)
+    # sequences of similar length share a block, which keeps the padding
+    # small
+    order = np.argsort(lengths, kind='stable')
+    observations, lengths = observations[order], lengths[order]
+    num_sequences = len(lengths)
+    num_steps = max(int(lengths.sum()), 1)
+
+    if max_workers == 1:
+        _init_worker(observations, lengths)
+        tasks = [(0, num_sequences)]
+        pool = None
+    else:
+        tasks = [(start, min(start + block_size, num_sequences))
+                 for start in range(0, num_sequences, block_size)]
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers, initializer=_init_worker,
+            initargs=(observations, lengths))
+
+    log_likelihoods = []
+    try:
+        for _ in range(iterations + 1):
+            parameters = _parameters(grid)
+            if pool is None:
+                results = [_block_counts(parameters, start, end, block_size)
+                           for start, end in tasks]
+            else:
+                futures = [pool.submit(_block_counts, parameters, start, end,
+                                       block_size)
+                           for start, end in tasks]
+                results = [future.result() for future in futures]
+            transition_counts, offset_counts, observed, log_likelihood = \
+                [sum(values) for values in list(zip(*results))[:4]]
+            impossible = np.concatenate([result[-1] for result in results])
+            if len(impossible) > 0:
+                raise ValueError(
+                    'observation sequences %s are impossible under the model'
+                    % ', '.join(str(n) for n in sorted(order[impossible])))
+
+            log_likelihoods.append(float(log_likelihood))
+            if len(log_likelihoods) > iterations or \
+               len(log_likelihoods) > 1 and \
+               (log_likelihoods[-1] - log_likelihoods[-2]) / num_steps < \
+               tolerance:
+                break
+            grid = maximize(grid, model, transition_counts, offset_counts,
+                            observed)
+            model = engine.build_grid_model_arrays(grid)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return grid, log_likelihoods
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Fit the rover model to the observations in trajectory '
+                    'files with Baum-Welch.')
+    parser.add_argument('files', nargs='+',
+                        help='trajectory files in the format of test.txt')
+    parser.add_argument('-n', '--iterations', type=int, default=20,
+                        help='largest number of EM iterations '
+                             '(default: %(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='number of worker processes (default: '
+                             '%(default)s)')
+    args = parser.parse_args(argv)
+
+    observation_sequences = [rover.load_data(filename)[1]
+                             for filename in args.files]
+    try:
+        grid, log_likelihoods = baum_welch(observation_sequences,
+                                           iterations=args.iterations,
+                                           max_workers=args.workers)
+    except ValueError as error:
+        parser.exit(1, '%s (sequence n is the n-th file, counting from 0)\n'
+                       % error)
+    for i, log_likelihood in enumerate(log_likelihoods):
+        print('iteration %d: log-likelihood %.4f' % (i, log_likelihood))
+    print('transition weights (rows: previous action, columns: next action, '
+          'in the order %s):' % ', '.join(rover.ACTIONS))
+    print(np.array2string(grid.transition_weights, precision=4))
+    print('sensor weights:')
+    for (dx, dy), weight in zip(grid.sensor_offsets(), grid.sensor_weights):
+        print('  (%+d, %+d) %.4f' % (dx, dy, weight))
+
+if __name__ == '__main__':
+    main()
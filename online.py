@@ -0,0 +1,272 @@
+import collections
+import numpy as np
+import engine
+
+class OnlineFilter:
+    """
+    Filters the rover's hidden state one observation at a time.
+
+    Each update costs one sparse mat-vec over the transition matrix. With
+    lag > 0 the filter also keeps the last lag+1 forward messages, which is
+    enough to smooth the estimate from lag steps ago without revisiting the
+    rest of the history.
+
+    Attributes
+    ----------
+    model: the ModelArrays the filter runs on
+    lag: the fixed smoothing lag, 0 for plain filtering
+    time_step: the time step of the latest observation, -1 before the first
+    belief: the filtered distribution at time_step, as a vector
+
+    Methods
+    -------
+    update(observation):
+      consumes an observation (x, y) or None and returns the filtered
+      Distribution for the new time step
+    smoothed():
+      returns (time step, Distribution) with the fixed-lag smoothed estimate
+      for time step time_step - lag, or None if fewer than lag+1
+      observations have been seen
+    """
+    def __init__(self, model=None, lag=0):
+        if model is None:
+            model = engine.rover_model_arrays()
+        if lag < 0:
+            raise ValueError('lag must be non-negative')
+        self.model     = model
+        self.lag       = lag
+        self.time_step = -1
+        self.belief    = None
+        # the last lag+1 forward messages and the observations that came
+        # after the oldest of them
+        self._messages     = collections.deque(maxlen=lag+1)
+        self._observations = collections.deque(maxlen=lag)
+
+    def update(self, observation):
+        if observation is None:
+            observation_index = engine.MISSING
+        else:
+            observation_index = self.model.observation_index[observation]
+
+        if self.belief is None:
+            message = self.model.prior
+        else:
+            message = self.model.transitions_t.dot(self.belief)
+        message = message * self.model.likelihood(observation_index)
+        normalization_constant = message.sum()
+        if normalization_constant == 0:
+            raise ValueError('observation %r at time step %d is impossible '
+                             'under the current belief'
+                             % (observation, self.time_step + 1))
+
+        self.belief     = message / normalization_constant
+        self.time_step += 1
+        if self.lag > 0:
+            if len(self._messages) > 0:
+                self._observations.append(observation_index)
+            self._messages.append(self.belief)
+        return self.model.to_array_distribution(self.belief.copy())
+
+    def smoothed(self):
+        if self.lag == 0:
+            if self.belief is None:
+                return None
+            return self.time_step, self.model.to_array_distribution(self.belief.copy())
+        if len(self._messages) <= self.lag:
+            return None
+
+        backward_message = np.ones(self.model.num_states)
+        for observation_index in reversed(self._observations):
+            backward_message = self.model.transitions.dot(
+                self.model.likelihood(observation_index) * backward_message)
+            backward_message /= backward_message.sum()
+
+        marginal = self._messages[0] * backward_message
+        marginal /= marginal.sum()
+        return self.time_step - self.lag, self.model.to_array_distribution(marginal)
+
+class SmoothingSession:
+    """
+    Keeps the forward, backward and Viterbi messages of one observation
+    sequence, so that backfilling or correcting an observation only
+    recomputes the messages it affects.
+
+    A change at time step k can only alter the forward messages from k on
+    and the backward messages before k. Each sweep stops as soon as a
+    recomputed message agrees with the cached one to within tolerance, since
+    the rest of the sweep would then reproduce the cache. A sequence that
+    is impossible under the model raises ValueError, both on construction
+    and from set_observation().
+
+    Attributes
+    ----------
+    model: the ModelArrays the session runs on
+    observations: the current observation indices (engine.MISSING when
+      missing)
+    tolerance: the largest absolute difference between a recomputed and a
+      cached message (normalized, or for the Viterbi scores shifted to a
+      maximum of 0) that counts as converged
+    last_update: (first, last) time steps whose marginals the last call to
+      set_observation() changed
+
+    Methods
+    -------
+    set_observation(time_step, observation):
+      replaces the observation at time_step with (x, y) or None and updates
+      the cached messages; raises ValueError, and keeps the old observation,
+      if the change makes the sequence impossible
+    marginal(time_step):
+      returns the smoothed Distribution at time_step
+    marginals():
+      returns the T x |Z| array of smoothed marginals
+    viterbi():
+      returns the most likely sequence of hidden states
+    """
+    def __init__(self, observations, model=None, tolerance=1e-12):
+        if model is None:
+            model = engine.rover_model_arrays()
+        self.model        = model
+        self.observations = model.encode_observations(observations)
+        self.tolerance    = tolerance
+        self.last_update  = None
+
+        num_time_steps = len(self.observations)
+        self._forward_messages  = np.empty((num_time_steps, model.num_states))
+        self._backward_messages = np.empty((num_time_steps, model.num_states))
+        self._update_forward(0, num_time_steps)
+        self._update_backward(num_time_steps-1, -1)
+
+        # the Viterbi scores and backpointers are computed on the first call
+        # to viterbi()
+        self._W = None
+        self._path_trellis = None
+        self._viterbi_dirty = None
+
+    def _update_forward(self, first, last):
+        # recomputes the forward messages from first on; the messages after
+        # last are only recomputed until they converge. The cache is only
+        # written once the sweep is through, so a ValueError for an
+        # impossible sequence leaves it untouched
+        messages = []
+        for i in range(first, len(self.observations)):
+            if i == 0:
+                message = self.model.prior
+            else:
+                previous = messages[-1] if messages else \
+                           self._forward_messages[i-1]
+                message = self.model.transitions_t.dot(previous)
+            message = message * self.model.likelihood(self.observations[i])
+            normalization_constant = message.sum()
+            if normalization_constant == 0:
+                raise ValueError('the observations are impossible under the '
+                                 'model from time step %d on' % i)
+            message = message / normalization_constant
+            if i > last and np.abs(message - self._forward_messages[i]).max() \
+                            <= self.tolerance:
+                break
+            messages.append(message)
+        if messages:
+            self._forward_messages[first:first+len(messages)] = messages
+        return first + len(messages) - 1
+
+    def _update_backward(self, first, last):
+        # recomputes the backward messages from first down; the messages
+        # before last are only recomputed until they converge
+        num_time_steps = len(self.observations)
+        for i in range(first, -1, -1):
+            if i == num_time_steps - 1:
+                message = np.full(self.model.num_states,
+                                  1. / self.model.num_states)
+            else:
+                message = engine._backward_step(self.model,
+                                                self._backward_messages[i+1],
+                                                self.observations[i+1])
+            if i < last and \
+               np.abs(message - self._backward_messages[i]).max() <= \
+               self.tolerance:
+                return i + 1
+            self._backward_messages[i] = message
+        return 0
+
+    def set_observation(self, time_step, observation):
+        if observation is None:
+            observation_index = engine.MISSING
+        else:
+            observation_index = self.model.observation_index[observation]
+        if not 0 <= time_step < len(self.observations):
+            raise IndexError('time step %d is outside the sequence'
+                             % time_step)
+        previous = self.observations[time_step]
+        self.observations[time_step] = observation_index
+        try:
+            last = self._update_forward(time_step, time_step)
+        except ValueError:
+            self.observations[time_step] = previous
+            raise
+        first = time_step
+        if time_step > 0:
+            first = self._update_backward(time_step - 1, time_step - 1)
+        self.last_update = (first, last)
+
+        if self._viterbi_dirty is None:
+            self._viterbi_dirty = (time_step, time_step)
+        else:
+            self._viterbi_dirty = (min(self._viterbi_dirty[0], time_step),
+                                   max(self._viterbi_dirty[1], time_step))
+
+    def marginal(self, time_step):
+        marginal = self._forward_messages[time_step] * \
+                   self._backward_messages[time_step]
+        return self.model.to_array_distribution(marginal / marginal.sum())
+
+    def marginals(self):
+        marginals = self._forward_messages * self._backward_messages
+        return marginals / marginals.sum(axis=1, keepdims=True)
+
+    def viterbi(self):
+        log_prior, predecessors, log_transitions = self.model.log_arrays()
+        rows = np.arange(self.model.num_states)
+        num_time_steps = len(self.observations)
+        if self._W is None:
+            self._W = np.empty((num_time_steps, self.model.num_states))
+            self._path_trellis = np.zeros((num_time_steps,
+                                           self.model.num_states),
+                                          dtype=np.int32)
+            first, last = 0, num_time_steps - 1
+        elif self._viterbi_dirty is not None:
+            first, last = self._viterbi_dirty
+        else:
+            first = num_time_steps
+        self._viterbi_dirty = None
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for i in range(first, num_time_steps):
+                log_likelihood = np.log(self.model.likelihood(
+                    self.observations[i]))
+                if i == 0:
+                    W = log_likelihood + log_prior
+                    backpointers = self._path_trellis[0]
+                else:
+                    scores = log_transitions + self._W[i-1][predecessors]
+                    best = scores.argmax(axis=1)
+                    backpointers = predecessors[rows, best]
+                    W = log_likelihood + scores[rows, best]
+                # a change only shifts the later scores by a constant once
+                # its effect has died out, so compare them up to that shift
+                if i > last and \
+                   np.array_equal(backpointers, self._path_trellis[i]) and \
+                   np.array_equal(np.isfinite(W), np.isfinite(self._W[i])):
+                    finite = np.isfinite(W)
+                    difference = (W[finite] - W[finite].max()) - \
+                                 (self._W[i][finite] - self._W[i][finite].max())
+                    if np.abs(difference).max() <= self.tolerance:
+                        break
+                self._W[i] = W
+                self._path_trellis[i] = backpointers
+
+        estimated_hidden_states = [None] * num_time_steps
+        z = int(self._W[num_time_steps-1].argmax())
+        for i in range(num_time_steps-1, -1, -1):
+            estimated_hidden_states[i] = self.model.hidden_states[z]
+            z = int(self._path_trellis[i, z])
+        return estimated_hidden_states
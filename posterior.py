@@ -0,0 +1,99 @@
+import numpy as np
+import rover
+
+#-----------------------------------------------------------------------------
+# Position summaries of the posterior over hidden states.
+#
+# The marginals that engine.forward_backward() returns are T x |Z| arrays over
+# (x, y, action) states. Most consumers only care about the position, so the
+# functions below sum out the action once, by a reduction over the state
+# index, and compute modes, means and credible regions on the resulting
+# T x W x H array.
+
+def marginal_array(model, marginals):
+    """
+    Inputs
+    ------
+    model: the engine.ModelArrays the marginals are over
+    marginals: a list of distributions over hidden states, e.g. the output
+        of inference.forward_backward()
+
+    Output
+    ------
+    The T x |Z| array of the marginals
+    """
+    array = np.zeros((len(marginals), model.num_states))
+    for i, marginal in enumerate(marginals):
+        if isinstance(marginal, rover.ArrayDistribution) and \
+           marginal.states is model.hidden_states:
+            array[i] = marginal.vector
+        else:
+            for z, p in marginal.items():
+                array[i, model.state_index[z]] = p
+    return array
+
+def position_posterior(model, marginals):
+    """
+    Inputs
+    ------
+    model: the engine.ModelArrays the marginals are over
+    marginals: a T x |Z| array of marginals (or a single |Z| vector)
+
+    Output
+    ------
+    A T x W x H array whose [i, x, y] entry is the probability that the rover
+    is at (x, y) at time step i, with W and H the extent of the hidden states
+    """
+    marginals = np.asarray(marginals)
+    xs, ys = model.positions()
+    grid_width, grid_height = int(xs.max()) + 1, int(ys.max()) + 1
+
+    # sort the states by cell, so that each cell is one contiguous run
+    cells = xs * grid_height + ys
+    order = np.argsort(cells, kind='stable')
+    starts = np.flatnonzero(np.r_[True, np.diff(cells[order]) != 0])
+
+    posterior = np.zeros(marginals.shape[:-1] + (grid_width * grid_height,))
+    posterior[..., cells[order][starts]] = \
+        np.add.reduceat(marginals[..., order], starts, axis=-1)
+    return posterior.reshape(marginals.shape[:-1] + (grid_width, grid_height))
+
+def position_modes(posterior):
+    # the most likely (x, y) at each time step, as a T x 2 int array
+    grid_height = posterior.shape[-1]
+    flat = posterior.reshape(posterior.shape[:-2] + (-1,)).argmax(axis=-1)
+    return np.stack([flat // grid_height, flat % grid_height], axis=-1)
+
+def expected_positions(posterior):
+    # the posterior mean of (x, y) at each time step, as a T x 2 float array
+    grid_width, grid_height = posterior.shape[-2:]
+    total = posterior.sum(axis=(-2, -1))
+    x = posterior.sum(axis=-1) @ np.arange(grid_width)
+    y = posterior.sum(axis=-2) @ np.arange(grid_height)
+    return np.stack([x / total, y / total], axis=-1)
+
+def credible_regions(posterior, mass=.9):
+    """
+    Inputs
+    ------
+    posterior: a T x W x H position posterior
+    mass: the probability the region has to cover
+
+    Output
+    ------
+    A T x W x H bool array that marks, at each time step, the smallest set of
+    cells whose total probability is at least mass (taking the most likely
+    cells first, and the first cell in x, y order on ties)
+    """
+    shape = posterior.shape
+    flat = posterior.reshape(shape[:-2] + (-1,))
+    order = np.argsort(-flat, axis=-1, kind='stable')
+    cumulative = np.cumsum(np.take_along_axis(flat, order, axis=-1), axis=-1)
+    # the number of cells needed, allowing for rounding in the cumulative sum
+    total = cumulative[..., -1:]
+    sizes = (cumulative < mass * total * (1 - 1e-12)).sum(axis=-1) + 1
+
+    in_region = np.arange(flat.shape[-1]) < sizes[..., None]
+    regions = np.zeros(flat.shape, dtype=bool)
+    np.put_along_axis(regions, order, in_region, axis=-1)
+    return regions.reshape(shape)
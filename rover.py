@@ -1,8 +1,14 @@
+import collections.abc
+import functools
+import types
 import numpy as np
 
 GRID_WIDTH  = 12
 GRID_HEIGHT = 8
 
+# number of grid sizes whose model tables are kept around at the same time
+MODEL_CACHE_SIZE = 4
+
 #-----------------------------------------------------------------------------
 # Convention: (x, y) = (0, 0) is the top left of the grid
 #
@@ -49,6 +55,104 @@ class Distribution(dict):
 
         return arg_max
 
+class FrozenDistribution(Distribution):
+    """
+    A read-only Distribution. The model tables hand out the same instance to
+    every caller, so modifying one in place would corrupt the model.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('FrozenDistribution is read-only')
+
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = renormalize = _read_only
+
+    def __reduce__(self):
+        return (FrozenDistribution, (dict(self),))
+
+class ArrayDistribution(collections.abc.MutableMapping):
+    """
+    A Distribution stored as a float vector over a fixed list of states.
+
+    The list of states and the dict from state to position are shared by
+    every ArrayDistribution over the same model, so each one only costs its
+    vector, 8 bytes per state. Like Distribution, a state that is not listed
+    (or has probability 0) reads as 0, and keys(), items() and len() only
+    cover the states with non-zero probability.
+
+    Attributes
+    ----------
+    states: the list of states, states[i] has position i
+    position: dict mapping each state to its position
+    vector: the probabilities, vector[i] belongs to states[i]
+
+    Methods
+    -------
+    renormalize():
+      scales all the probabilities so that they sum to 1
+    get_mode():
+      returns the state with the highest probability, the first one on ties
+    copy():
+      returns an ArrayDistribution with its own copy of the vector
+    """
+    __slots__ = ('states', 'position', 'vector')
+
+    def __init__(self, states, position, vector=None):
+        self.states   = states
+        self.position = position
+        if vector is None:
+            vector = np.zeros(len(states))
+        self.vector   = vector
+
+    def __getitem__(self, key):
+        i = self.position.get(key)
+        if i is None:
+            return 0
+        return float(self.vector[i])
+
+    def __setitem__(self, key, probability):
+        self.vector[self.position[key]] = probability
+
+    def __delitem__(self, key):
+        self.vector[self.position[key]] = 0.
+
+    def __contains__(self, key):
+        i = self.position.get(key)
+        return i is not None and self.vector[i] != 0
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.vector))
+
+    def __repr__(self):
+        return 'ArrayDistribution(%r)' % (dict(self.items()),)
+
+    def keys(self):
+        return [self.states[i] for i in np.flatnonzero(self.vector).tolist()]
+
+    def values(self):
+        return self.vector[self.vector != 0].tolist()
+
+    def items(self):
+        nonzero = np.flatnonzero(self.vector)
+        return [(self.states[i], p) for i, p in
+                zip(nonzero.tolist(), self.vector[nonzero].tolist())]
+
+    def renormalize(self):
+        self.vector /= self.vector.sum()
+
+    def get_mode(self):
+        if not self.vector.any():
+            return None
+        return self.states[int(self.vector.argmax())]
+
+    def copy(self):
+        return ArrayDistribution(self.states, self.position, self.vector.copy())
+
+    def __reduce__(self):
+        return (ArrayDistribution, (self.states, self.position, self.vector))
+
 def get_all_hidden_states():
     # lists all possible hidden states
     all_states = []
@@ -85,56 +189,304 @@ def initial_distribution():
             prior[(x, y, 'stay')] = 1./(GRID_WIDTH*GRID_HEIGHT)
     return prior
 
+# actions in the order used by the action codes of GridModel
+ACTIONS = ['left', 'right', 'up', 'down', 'stay']
+_LEFT, _RIGHT, _UP, _DOWN, _STAY = range(5)
+
+# moves as (action code, dx, dy), in the order the transition model adds them
+_MOVES = [(_UP, 0, -1), (_DOWN, 0, 1), (_LEFT, -1, 0), (_RIGHT, 1, 0)]
+
+class GridModel:
+    """
+    The rover HMM on a grid of any size, built with array operations so that
+    grids with millions of hidden states stay cheap to set up.
+
+    Hidden state i is (state_x[i], state_y[i], ACTIONS[state_action[i]]),
+    numbered in the order of get_all_hidden_states(), and observed state
+    (x, y) has index x * height + y, the order of get_all_observed_states().
+
+    Attributes
+    ----------
+    width, height: the grid size
+    radius: the sensor radius; the observation falls on one of the cells
+      within this distance of the rover
+    stay_after_stay, move_after_stay, stay_after_move, keep_moving: the
+      transition weights, renormalized over the moves that stay on the grid
+    transition_weights: the same weights as an ACTIONS x ACTIONS array, whose
+      [a, b] entry weighs taking action b after action a; when passed in, it
+      replaces the four weights above
+    sensor_weights: the weight of each offset in sensor_offsets(),
+      renormalized over the offsets that stay on the grid; uniform by default
+    state_x, state_y, state_action: vectors describing the hidden states
+
+    Methods
+    -------
+    state_indices(x, y, action_code):
+      returns the indices of hidden states, -1 for states not on the grid
+    hidden_states(), observed_states():
+      list the states, like get_all_hidden_states() and
+      get_all_observed_states()
+    prior(), initial_distribution():
+      return the initial distribution as a vector, and as a Distribution
+    sensor_offsets():
+      lists the (dx, dy) offsets the sensor can report, ordered by dx first
+    transition_arrays(), emission_arrays():
+      return the CSR arrays (indptr, indices, data) of the transition matrix
+      (states x states) and of the emission matrix (states x observations)
+    transition_model(state), observation_model(state):
+      return read-only Distributions, built from the arrays on first use;
+      states outside the index get the same rules applied directly, on
+      every call
+    model_tables():
+      returns read-only mappings from every hidden state to both of the above
+    """
+    def __init__(self, width=GRID_WIDTH, height=GRID_HEIGHT, radius=1,
+                 stay_after_stay=.2, move_after_stay=.2,
+                 stay_after_move=.1, keep_moving=.9,
+                 transition_weights=None, sensor_weights=None):
+        self.width           = width
+        self.height          = height
+        self.radius          = radius
+        self.stay_after_stay = stay_after_stay
+        self.move_after_stay = move_after_stay
+        self.stay_after_move = stay_after_move
+        self.keep_moving     = keep_moving
+
+        if transition_weights is None:
+            transition_weights = np.diag([keep_moving] * len(ACTIONS))
+            transition_weights[:, _STAY] = stay_after_move
+            transition_weights[_STAY, :] = move_after_stay
+            transition_weights[_STAY, _STAY] = stay_after_stay
+        self.transition_weights = np.array(transition_weights, dtype=float)
+        if sensor_weights is None:
+            sensor_weights = np.ones(len(self.sensor_offsets()))
+        self.sensor_weights = np.array(sensor_weights, dtype=float)
+
+        x, y, action = np.meshgrid(np.arange(width, dtype=np.int32),
+                                   np.arange(height, dtype=np.int32),
+                                   np.arange(len(ACTIONS), dtype=np.int8),
+                                   indexing='ij')
+        # the previous action cannot have come from outside the grid
+        valid = ~(((x == 0) & (action == _RIGHT)) |
+                  ((x == width - 1) & (action == _LEFT)) |
+                  ((y == 0) & (action == _DOWN)) |
+                  ((y == height - 1) & (action == _UP)))
+        self.state_x      = x[valid]
+        self.state_y      = y[valid]
+        self.state_action = action[valid]
+        self._lookup = np.full(valid.shape, -1, dtype=np.int64)
+        self._lookup[valid] = np.arange(len(self.state_x))
+
+        self._transitions  = None
+        self._emissions    = None
+        self._transition_table  = {}
+        self._observation_table = {}
+
+    @property
+    def num_states(self):
+        return len(self.state_x)
+
+    def state_indices(self, x, y, action_code):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        indices = self._lookup[np.where(inside, x, 0), np.where(inside, y, 0),
+                               action_code]
+        return np.where(inside, indices, -1)
+
+    def hidden_states(self):
+        return list(zip(self.state_x.tolist(), self.state_y.tolist(),
+                        [ACTIONS[a] for a in self.state_action.tolist()]))
+
+    def observed_states(self):
+        return [(x, y) for x in range(self.width) for y in range(self.height)]
+
+    def prior(self):
+        prior = np.zeros(self.num_states)
+        prior[self.state_action == _STAY] = 1./(self.width*self.height)
+        return prior
+
+    def initial_distribution(self):
+        prior = Distribution()
+        for x in range(self.width):
+            for y in range(self.height):
+                prior[(x, y, 'stay')] = 1./(self.width*self.height)
+        return prior
+
+    def sensor_offsets(self):
+        r = int(np.floor(self.radius))
+        return [(dx, dy) for dx in range(-r, r + 1) for dy in range(-r, r + 1)
+                if dx**2 + dy**2 <= self.radius**2]
+
+    def transition_arrays(self):
+        if self._transitions is None:
+            x, y, action = self.state_x, self.state_y, self.state_action
+            targets = [self._lookup[x, y, _STAY]]
+            weights = [self.transition_weights[action, _STAY]]
+            for code, dx, dy in _MOVES:
+                inside = (x + dx >= 0) & (x + dx < self.width) & \
+                         (y + dy >= 0) & (y + dy < self.height)
+                targets.append(self.state_indices(x + dx, y + dy, code))
+                weights.append(np.where(inside,
+                                        self.transition_weights[action, code],
+                                        0.))
+            targets = np.stack(targets, axis=1)
+            weights = np.stack(weights, axis=1)
+            weights = weights / weights.sum(axis=1, keepdims=True)
+
+            # sort every row by target index and drop the impossible moves
+            targets = np.where(weights > 0, targets, self.num_states)
+            order   = np.argsort(targets, axis=1, kind='stable')
+            targets = np.take_along_axis(targets, order, axis=1)
+            weights = np.take_along_axis(weights, order, axis=1)
+            keep    = targets < self.num_states
+            indptr  = np.concatenate(([0], np.cumsum(keep.sum(axis=1))))
+            self._transitions = (indptr, targets[keep], weights[keep])
+        return self._transitions
+
+    def emission_arrays(self):
+        if self._emissions is None:
+            offsets = self.sensor_offsets()
+            x, y = self.state_x, self.state_y
+            observed = np.stack([(x + dx) * self.height + (y + dy)
+                                 for dx, dy in offsets], axis=1)
+            inside = np.stack([(x + dx >= 0) & (x + dx < self.width) &
+                               (y + dy >= 0) & (y + dy < self.height)
+                               for dx, dy in offsets], axis=1)
+            counts  = inside.sum(axis=1)
+            indptr  = np.concatenate(([0], np.cumsum(counts)))
+            weights = np.where(inside, self.sensor_weights, 0.)
+            weights = (weights / weights.sum(axis=1, keepdims=True))[inside]
+            # offsets are ordered by dx first, so the kept observation
+            # indices of every row are already sorted
+            self._emissions = (indptr, observed[inside].astype(np.int64),
+                               weights)
+        return self._emissions
+
+    def _state_index(self, state):
+        # the index of a hidden state, -1 for states outside the index
+        x, y, action = state
+        if not (0 <= x < self.width and 0 <= y < self.height) or \
+           action not in ACTIONS:
+            return -1
+        return self._lookup[x, y, ACTIONS.index(action)]
+
+    def _transition_rule(self, state):
+        # the transition rule applied to a single state, for states outside
+        # the index (e.g. (0, 0, 'right') or positions off the grid); moves
+        # are checked against the grid edge they head towards, as in the
+        # original transition_model()
+        x, y, action = state
+        next_states = Distribution()
+        if action not in ACTIONS:
+            next_states[(x, y, 'stay')] = 1.
+            return next_states
+        weights = self.transition_weights[ACTIONS.index(action)].tolist()
+        if weights[_STAY] > 0:
+            next_states[(x, y, 'stay')] = weights[_STAY]
+        for code, dx, dy in _MOVES:
+            allowed = (dx < 0 and x > 0) or (dx > 0 and x < self.width - 1) or \
+                      (dy < 0 and y > 0) or (dy > 0 and y < self.height - 1)
+            if allowed and weights[code] > 0:
+                next_states[(x + dx, y + dy, ACTIONS[code])] = weights[code]
+        next_states.renormalize()
+        return next_states
+
+    def _observation_rule(self, x, y):
+        # the sensor model at a single position, for states outside the index
+        observed_states = Distribution()
+        for (dx, dy), weight in zip(self.sensor_offsets(),
+                                    self.sensor_weights.tolist()):
+            if 0 <= x + dx < self.width and 0 <= y + dy < self.height and \
+               weight > 0:
+                observed_states[(x + dx, y + dy)] = weight
+        observed_states.renormalize()
+        return observed_states
+
+    def transition_model(self, state):
+        if state not in self._transition_table:
+            i = self._state_index(state)
+            if i < 0:
+                # not memoized, so that arbitrary queries cannot grow the
+                # table without bound
+                return FrozenDistribution(self._transition_rule(state))
+            indptr, indices, data = self.transition_arrays()
+            self._transition_table[state] = FrozenDistribution(
+                (self._state(j), p) for j, p in
+                zip(indices[indptr[i]:indptr[i+1]].tolist(),
+                    data[indptr[i]:indptr[i+1]].tolist()))
+        return self._transition_table[state]
+
+    def observation_model(self, state):
+        if state not in self._observation_table:
+            i = self._state_index(state)
+            if i < 0:
+                return FrozenDistribution(
+                    self._observation_rule(state[0], state[1]))
+            indptr, indices, data = self.emission_arrays()
+            position = (int(self.state_x[i]), int(self.state_y[i]))
+            # every action at a position shares the same distribution
+            observed_states = self._observation_table.get(position)
+            if observed_states is None:
+                observed_states = FrozenDistribution(
+                    (divmod(k, self.height), p) for k, p in
+                    zip(indices[indptr[i]:indptr[i+1]].tolist(),
+                        data[indptr[i]:indptr[i+1]].tolist()))
+                self._observation_table[position] = observed_states
+            self._observation_table[state] = observed_states
+        return self._observation_table[state]
+
+    def _state(self, i):
+        return (int(self.state_x[i]), int(self.state_y[i]),
+                ACTIONS[self.state_action[i]])
+
+    def model_tables(self):
+        transitions  = {}
+        observations = {}
+        for state in self.hidden_states():
+            transitions[state]  = self.transition_model(state)
+            observations[state] = self.observation_model(state)
+        return (types.MappingProxyType(transitions),
+                types.MappingProxyType(observations))
+
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def _grid_model(grid_width, grid_height):
+    return GridModel(grid_width, grid_height)
+
+def grid_model():
+    # the GridModel for the current GRID_WIDTH and GRID_HEIGHT; one model is
+    # kept per grid size, so changing either constant selects a new one
+    return _grid_model(GRID_WIDTH, GRID_HEIGHT)
+
+@functools.lru_cache(maxsize=MODEL_CACHE_SIZE)
+def _model_tables(grid_width, grid_height):
+    return _grid_model(grid_width, grid_height).model_tables()
+
+def model_tables():
+    # returns two read-only mappings from every hidden state to its next
+    # state Distribution and to its observation Distribution, for the
+    # current grid size
+    return _model_tables(GRID_WIDTH, GRID_HEIGHT)
+
+# cache_clear functions of caches built elsewhere from the grid model (such
+# as engine.rover_model_arrays()); clear_model_tables() calls them too
+_dependent_cache_clears = []
+
+def clear_model_tables():
+    # drops every cached grid model and model table, and everything built
+    # from them
+    _model_tables.cache_clear()
+    _grid_model.cache_clear()
+    for cache_clear in _dependent_cache_clears:
+        cache_clear()
+
 def transition_model(state):
     # given a hidden state, return the Distribution for the next hidden state
-    x, y, action = state
-    next_states  = Distribution()
-
-    # we can always stay where we are
-    if action == 'stay':
-        next_states[(x, y, 'stay')] = .2
-    else:
-        next_states[(x, y, 'stay')] = .1
-
-    if y > 0: # we can go up
-        if action == 'stay':
-            next_states[(x, y-1, 'up')] = .2
-        if action == 'up':
-            next_states[(x, y-1, 'up')] = .9
-    if y < GRID_HEIGHT - 1: # we can go down
-        if action == 'stay':
-            next_states[(x, y+1, 'down')] = .2
-        if action == 'down':
-            next_states[(x, y+1, 'down')] = .9
-    if x > 0: # we can go left
-        if action == 'stay':
-            next_states[(x-1, y, 'left')] = .2
-        if action == 'left':
-            next_states[(x-1, y, 'left')] = .9
-    if x < GRID_WIDTH - 1: # we can go right
-        if action == 'stay':
-            next_states[(x+1, y, 'right')] = .2
-        if action == 'right':
-            next_states[(x+1, y, 'right')] = .9
-
-    next_states.renormalize()
-    return next_states
+    return grid_model().transition_model(state)
 
 def observation_model(state):
     # given a hidden state, return the Distribution for its observation
-    x, y, action    = state
-    observed_states = Distribution()
-
-    radius = 1
-    for x_new in range(x - radius, x + radius + 1):
-        for y_new in range(y - radius, y + radius + 1):
-            if x_new >= 0 and x_new <= GRID_WIDTH - 1 and \
-               y_new >= 0 and y_new <= GRID_HEIGHT - 1:
-                if (x_new - x)**2 + (y_new - y)**2 <= radius**2:
-                    observed_states[(x_new, y_new)] = 1.
-
-    observed_states.renormalize()
-    return observed_states
+    return grid_model().observation_model(state)
 
 
 def load_data(filename):
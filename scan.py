@@ -0,0 +1,276 @@
+import concurrent.futures
+import os
+import numpy as np
+import engine
+
+#-----------------------------------------------------------------------------
+# Parallel-in-time forward-backward and Viterbi.
+#
+# A long sequence is cut into chunks. The messages of an HMM compose
+# associatively: within one chunk, the forward recursion is a product of
+# |Z| x |Z| sum-product operators, the backward recursion is a product of
+# their transposes, and Viterbi is a product of max-plus operators. The work
+# runs in three phases:
+#
+#   1. every chunk reduces its time steps to one operator (in parallel),
+#   2. the operators are combined across chunks to find the messages at the
+#      chunk boundaries (sequential, one operator application per chunk),
+#   3. every chunk reruns the ordinary recursion from its boundary messages
+#      (in parallel).
+#
+# The operators are kept row-sparse: only the states that can produce the
+# observations and be reached get a row. Phase 1 still costs about |Z| times
+# the work of the sequential recursion for the rows that remain, so this
+# pays off for long sequences on grids of moderate size, when enough cores
+# are available.
+
+_worker_model = None
+
+def _init_worker(model):
+    global _worker_model
+    _worker_model = model
+
+def _chunks(num_time_steps, num_chunks):
+    # (start, end) of each chunk, as even as possible
+    bounds = np.linspace(0, num_time_steps, num_chunks + 1).round()
+    bounds = bounds.astype(np.int64)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])
+            if end > start]
+
+def _propagate(matrix, states, block, log_space=False):
+    # multiplies a row-sparse operator, given by the sorted states of its
+    # non-zero rows and the dense block of those rows, on the left by the
+    # transpose of matrix; in log space the product is max-plus
+    if log_space:
+        owners, columns, values = matrix.gather_rows(states,
+                                                     np.log(matrix.data))
+    else:
+        owners, columns, values = matrix.gather_rows(states)
+    order = np.argsort(columns, kind='stable')
+    owners, columns, values = owners[order], columns[order], values[order]
+    targets, starts = np.unique(columns, return_index=True)
+    if log_space:
+        contributions = values[:, None] + block[owners]
+        return targets, np.maximum.reduceat(contributions, starts, axis=0)
+    contributions = values[:, None] * block[owners]
+    return targets, np.add.reduceat(contributions, starts, axis=0)
+
+def _restrict(states, block, weights, log_space=False):
+    # applies a diagonal of likelihoods to a row-sparse operator and drops
+    # the rows that become impossible
+    if log_space:
+        with np.errstate(divide='ignore'):
+            block = np.log(weights)[:, None] + block
+        keep = np.isfinite(block).any(axis=1)
+    else:
+        block = weights[:, None] * block
+        keep = block.any(axis=1)
+        if keep.any():
+            block = block / block[keep].max()
+    return states[keep], block[keep]
+
+def _identity(model, log_space=False):
+    states = np.arange(model.num_states)
+    if log_space:
+        block = np.full((model.num_states, model.num_states), -np.inf)
+        np.fill_diagonal(block, 0.)
+        return states, block
+    return states, np.eye(model.num_states)
+
+def _forward_operators(observations, start, end):
+    # the forward and backward sum-product operators of one chunk as
+    # row-sparse (states, block) pairs, each scaled by a constant; the
+    # forward one maps the forward message at max(start, 1) - 1 to the one
+    # at end - 1, and the backward one maps the backward message at
+    # min(end, T-1) to the one at start
+    model = _worker_model
+    num_time_steps = len(observations)
+    states, block = _identity(model)
+    for i in range(max(start, 1), end):
+        states, block = _propagate(model.transitions, states, block)
+        states, block = _restrict(states, block,
+                                  model.likelihood_at(observations[i], states))
+    forward_operator = (states, block)
+
+    states, block = _identity(model)
+    for i in range(min(end, num_time_steps-1) - 1, start - 1, -1):
+        states, block = _restrict(states, block,
+                                  model.likelihood_at(observations[i+1],
+                                                      states))
+        states, block = _propagate(model.transitions_t, states, block)
+        block = block / block.max()
+    return forward_operator, (states, block)
+
+def _smooth_chunk(observations, start, end, forward_message,
+                  backward_message):
+    # the marginals of one chunk, given the forward message at
+    # max(start, 1) - 1 and the backward message at min(end, T-1)
+    model = _worker_model
+    num_time_steps = len(observations)
+    forward_messages = np.empty((end - start, model.num_states))
+    for i in range(start, end):
+        if i > 0:
+            forward_message = engine._forward_step(model, forward_message,
+                                                   observations[i])
+        forward_messages[i-start] = forward_message
+
+    marginals = np.empty((end - start, model.num_states))
+    for i in range(end-1, start-1, -1):
+        if i < num_time_steps-1 and (i < end-1 or end < num_time_steps):
+            backward_message = engine._backward_step(model, backward_message,
+                                                     observations[i+1])
+        marginal = forward_messages[i-start] * backward_message
+        marginals[i-start] = marginal / marginal.sum()
+    return marginals
+
+def _max_plus_operator(observations, start, end):
+    # the max-plus operator of one chunk as a row-sparse (states, block)
+    # pair: entry [j, i] of the operator is the best log score of reaching
+    # state j at end - 1 from state i at max(start, 1) - 1
+    model = _worker_model
+    states, block = _identity(model, log_space=True)
+    for i in range(max(start, 1), end):
+        states, block = _propagate(model.transitions, states, block,
+                                   log_space=True)
+        states, block = _restrict(states, block,
+                                  model.likelihood_at(observations[i], states),
+                                  log_space=True)
+    return states, block
+
+def _decode_chunk(observations, start, end, W, last_state):
+    # the Viterbi path of one chunk, given the scores at max(start, 1) - 1
+    # and the state the path takes at end - 1
+    model = _worker_model
+    _, predecessors, log_transitions = model.log_arrays()
+    rows = np.arange(model.num_states)
+    first = max(start, 1)
+    path_trellis = np.zeros((end - first, model.num_states), dtype=np.int32)
+    with np.errstate(divide='ignore'):
+        for i in range(first, end):
+            scores = log_transitions + W[predecessors]
+            best = scores.argmax(axis=1)
+            path_trellis[i-first] = predecessors[rows, best]
+            W = np.log(model.likelihood(observations[i])) + scores[rows, best]
+
+    path = np.empty(end - start, dtype=np.int64)
+    path[-1] = last_state
+    for i in range(end-2, start-1, -1):
+        path[i-start] = path_trellis[i+1-first, path[i+1-start]]
+    return path
+
+class _Runner:
+    # runs chunk tasks on a process pool whose workers hold the model, or in
+    # this process when max_workers is 1
+    def __init__(self, model, max_workers):
+        self.model = model
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.pool = None
+
+    def __enter__(self):
+        if self.max_workers > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers, initializer=_init_worker,
+                initargs=(self.model,))
+        else:
+            _init_worker(self.model)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def map(self, function, *iterables):
+        if self.pool is not None:
+            return list(self.pool.map(function, *iterables))
+        return list(map(function, *iterables))
+
+def forward_backward(model, observations, num_chunks=None, max_workers=None):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    observations: a vector of observation indices (engine.MISSING when
+        missing)
+    num_chunks: number of chunks to cut the sequence into; defaults to the
+        number of workers
+    max_workers: number of worker processes; defaults to one per CPU, and 1
+        runs every chunk in this process
+
+    Output
+    ------
+    A T x |Z| array of marginals, equal to engine.forward_backward() up to
+    rounding
+    """
+    observations = np.asarray(observations)
+    num_time_steps = len(observations)
+    with _Runner(model, max_workers) as runner:
+        chunks = _chunks(num_time_steps, num_chunks or runner.max_workers)
+        starts = [start for start, _ in chunks]
+        ends   = [end for _, end in chunks]
+        operators = runner.map(_forward_operators,
+                               [observations] * len(chunks), starts, ends)
+
+        forward_boundaries = []
+        message = model.prior * model.likelihood(observations[0])
+        message = message / message.sum()
+        for (states, block), _ in operators:
+            forward_boundaries.append(message)
+            message = np.zeros(model.num_states)
+            message[states] = block.dot(forward_boundaries[-1])
+            message = message / message.sum()
+
+        backward_boundaries = [None] * len(chunks)
+        message = np.full(model.num_states, 1. / model.num_states)
+        for c in range(len(chunks)-1, -1, -1):
+            backward_boundaries[c] = message
+            states, block = operators[c][1]
+            message = np.zeros(model.num_states)
+            message[states] = block.dot(backward_boundaries[c])
+            message = message / message.sum()
+
+        marginals = runner.map(_smooth_chunk, [observations] * len(chunks),
+                               starts, ends, forward_boundaries,
+                               backward_boundaries)
+    return np.concatenate(marginals)
+
+def viterbi(model, observations, num_chunks=None, max_workers=None):
+    """
+    Inputs
+    ------
+    See forward_backward() above.
+
+    Output
+    ------
+    A vector with the index of the estimated hidden state at each time step,
+    the same path as engine.viterbi() unless two paths tie up to rounding
+    """
+    observations = np.asarray(observations)
+    num_time_steps = len(observations)
+    log_prior, _, _ = model.log_arrays()
+    with _Runner(model, max_workers) as runner:
+        chunks = _chunks(num_time_steps, num_chunks or runner.max_workers)
+        starts = [start for start, _ in chunks]
+        ends   = [end for _, end in chunks]
+        operators = runner.map(_max_plus_operator,
+                               [observations] * len(chunks), starts, ends)
+
+        boundaries = []
+        with np.errstate(divide='ignore'):
+            W = np.log(model.likelihood(observations[0])) + log_prior
+        for states, block in operators:
+            boundaries.append(W)
+            W = np.full(model.num_states, -np.inf)
+            W[states] = (block + boundaries[-1]).max(axis=1)
+
+        # walk the boundaries backwards to fix the state at every chunk end
+        last_states = [None] * len(chunks)
+        state = int(W.argmax())
+        for c in range(len(chunks)-1, -1, -1):
+            last_states[c] = state
+            states, block = operators[c]
+            row = np.searchsorted(states, state)
+            state = int((block[row] + boundaries[c]).argmax())
+
+        paths = runner.map(_decode_chunk, [observations] * len(chunks),
+                           starts, ends, boundaries, last_states)
+    return np.concatenate(paths)
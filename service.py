@@ -0,0 +1,421 @@
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import socket
+import sys
+import time
+import numpy as np
+import engine
+import online
+import rover
+
+#-----------------------------------------------------------------------------
+# Long-running localization service.
+#
+# The server builds the rover model arrays once and then answers requests
+# sent as one JSON object per line over a Unix socket or a localhost TCP
+# port. Every request carries an "id" that its response echoes, and an "op":
+#
+#   {"op": "decode", "observations": [[x, y], null, ...], "marginals": false}
+#       Viterbi path, most likely state of every marginal and log-likelihood
+#       of a whole sequence. Decode requests that arrive within batch_window
+#       seconds of each other run as one batched forward-backward/Viterbi.
+#   {"op": "open", "lag": 0}
+#       starts a streaming session (see online.OnlineFilter); it lasts until
+#       it is closed or the connection that opened it goes away
+#   {"op": "update", "session": s, "observation": [x, y] or null}
+#       adds one observation to a session and returns the filtered (and,
+#       with lag > 0, the smoothed) most likely state
+#   {"op": "close", "session": s}
+#   {"op": "stats"}
+#       request counts, latency percentiles and throughput
+#
+# Every response carries "latency_ms", or "error" if the request failed.
+
+class ServiceStats:
+    """
+    Latency and throughput counters of a LocalizationService.
+
+    Attributes
+    ----------
+    requests, errors: the number of requests answered and failed
+    batches, batched_requests: the number of decode batches run and the
+      number of decode requests they held
+    latencies: the latencies (in seconds) of the most recent requests
+
+    Methods
+    -------
+    record(latency, failed=False): counts one answered request
+    snapshot(): returns the counters and latency percentiles as a dict
+    """
+    def __init__(self, history=10000):
+        self.started          = time.perf_counter()
+        self.requests         = 0
+        self.errors           = 0
+        self.batches          = 0
+        self.batched_requests = 0
+        self.latencies        = collections.deque(maxlen=history)
+
+    def record(self, latency, failed=False):
+        self.requests += 1
+        self.errors   += failed
+        self.latencies.append(latency)
+
+    def snapshot(self):
+        uptime = time.perf_counter() - self.started
+        snapshot = {'requests': self.requests,
+                    'errors': self.errors,
+                    'uptime_s': uptime,
+                    'throughput_per_s': self.requests / uptime,
+                    'batches': self.batches,
+                    'mean_batch_size': self.batched_requests /
+                                       max(self.batches, 1)}
+        if self.latencies:
+            latencies = np.array(self.latencies) * 1000.
+            snapshot['latency_ms'] = {
+                'mean': float(latencies.mean()),
+                'p50':  float(np.percentile(latencies, 50)),
+                'p95':  float(np.percentile(latencies, 95)),
+                'p99':  float(np.percentile(latencies, 99)),
+                'max':  float(latencies.max())}
+        return snapshot
+
+class LocalizationService:
+    """
+    Serves localization requests from a model that is built once.
+
+    Attributes
+    ----------
+    model: the ModelArrays every request runs on
+    batch_window: how long (in seconds) the first decode request of a batch
+      waits for others to join it
+    max_batch_size: the largest number of sequences decoded together
+    stats: the ServiceStats of the service
+
+    Methods
+    -------
+    handle(request, opened=None):
+      coroutine that answers one request dict with a response dict; if
+      opened is a set, the ids of the sessions the request opens are added
+      to it (and those it closes removed), so the caller can close what is
+      left
+    serve_unix(path), serve_tcp(host, port):
+      coroutines that start listening and return the asyncio server
+    """
+    def __init__(self, model=None, batch_window=.005, max_batch_size=64):
+        if model is None:
+            model = engine.rover_model_arrays()
+        model.log_arrays()
+        self.model          = model
+        self.batch_window   = batch_window
+        self.max_batch_size = max_batch_size
+        self.stats          = ServiceStats()
+        self._sessions      = {}
+        self._session_ids   = itertools.count()
+        self._queue         = None
+        self._batcher       = None
+
+    def _encode(self, observation):
+        if observation is None:
+            return engine.MISSING
+        try:
+            return self.model.observation_index[tuple(observation)]
+        except (KeyError, TypeError):
+            raise ValueError('unknown observation %r' % (observation,))
+
+    def _session(self, request):
+        session = self._sessions.get(request.get('session'))
+        if session is None:
+            raise ValueError('unknown session %r' % (request.get('session'),))
+        return session
+
+    def _state(self, index):
+        return list(self.model.hidden_states[index])
+
+    async def handle(self, request, opened=None):
+        start = time.perf_counter()
+        response = {'id': request.get('id') if isinstance(request, dict)
+                          else None}
+        try:
+            if not isinstance(request, dict):
+                raise ValueError('a request must be a JSON object')
+            response.update(await self._dispatch(request, opened))
+        except ValueError as error:
+            response['error'] = str(error)
+        except Exception as error:
+            # any failure is reported to the client rather than dropping the
+            # connection
+            response['error'] = '%s: %s' % (type(error).__name__, error)
+        latency = time.perf_counter() - start
+        response['latency_ms'] = latency * 1000.
+        self.stats.record(latency, 'error' in response)
+        return response
+
+    async def _dispatch(self, request, opened):
+        op = request.get('op')
+        if op == 'decode':
+            observations = np.array([self._encode(observation) for observation
+                                     in request['observations']],
+                                    dtype=np.int64)
+            if len(observations) == 0:
+                raise ValueError('cannot decode an empty sequence')
+            return await self._decode(observations,
+                                      bool(request.get('marginals', False)))
+        elif op == 'open':
+            session = next(self._session_ids)
+            self._sessions[session] = online.OnlineFilter(
+                self.model, int(request.get('lag', 0)))
+            if opened is not None:
+                opened.add(session)
+            return {'session': session}
+        elif op == 'update':
+            session = self._session(request)
+            observation = request.get('observation')
+            if observation is not None:
+                observation = tuple(observation)
+                self._encode(observation)
+            session.update(observation)
+            response = {'time_step': session.time_step,
+                        'mode': self._state(int(session.belief.argmax()))}
+            smoothed = session.smoothed()
+            if session.lag > 0 and smoothed is not None:
+                time_step, marginal = smoothed
+                response['smoothed'] = {'time_step': time_step,
+                                        'mode': list(marginal.get_mode())}
+            return response
+        elif op == 'close':
+            self._session(request)
+            del self._sessions[request['session']]
+            if opened is not None:
+                opened.discard(request['session'])
+            return {}
+        elif op == 'stats':
+            return {'stats': self.stats.snapshot()}
+        raise ValueError('unknown op %r' % (op,))
+
+    async def _decode(self, observations, with_marginals):
+        if self._batcher is None:
+            self._queue   = asyncio.Queue()
+            self._batcher = asyncio.ensure_future(self._run_batches())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((observations, with_marginals, future))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.stats.batches          += 1
+            self.stats.batched_requests += len(batch)
+            # the numerical work runs off the event loop, so that requests
+            # keep arriving for the next batch meanwhile
+            try:
+                results = await loop.run_in_executor(None, self._decode_batch,
+                                                     batch)
+            except Exception as error:
+                results = [error] * len(batch)
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(ValueError(str(result)))
+                else:
+                    future.set_result(result)
+
+    def _decode_batch(self, batch):
+        lengths = np.array([len(observations) for observations, _, _ in batch])
+        padded = np.full((len(batch), lengths.max()), engine.MISSING,
+                         dtype=np.int64)
+        for n, (observations, _, _) in enumerate(batch):
+            padded[n, :lengths[n]] = observations
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            marginals, log_normalizers = engine.forward_backward_batch(
+                self.model, padded, lengths, return_normalizers=True)
+            paths = engine.viterbi_batch(self.model, padded, lengths)
+        log_likelihoods = log_normalizers.sum(axis=1)
+        results = []
+        for n, (_, with_marginals, _) in enumerate(batch):
+            if not np.isfinite(log_likelihoods[n]):
+                results.append(ValueError('the observations are impossible '
+                                          'under the model'))
+                continue
+            length = lengths[n]
+            result = {
+                'viterbi': [self._state(z) for z in paths[n, :length].tolist()],
+                'modes': [self._state(z) for z in
+                          marginals[n, :length].argmax(axis=1).tolist()],
+                'log_likelihood': float(log_likelihoods[n])}
+            if with_marginals:
+                result['marginals'] = [
+                    [[self._state(z), p] for z, p in
+                     zip(np.flatnonzero(marginal).tolist(),
+                         marginal[marginal > 0].tolist())]
+                    for marginal in marginals[n, :length]]
+            results.append(result)
+        return results
+
+    async def _serve_connection(self, reader, writer):
+        async def respond(request):
+            response = await self.handle(request, opened)
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+
+        pending = set()
+        # the sessions this connection opened and has not closed
+        opened = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = None
+                if isinstance(request, dict) and \
+                   request.get('op') == 'decode':
+                    # decodes are answered as their batch completes, possibly
+                    # out of order; everything else in the order received
+                    task = asyncio.ensure_future(respond(request))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                else:
+                    await respond(request)
+            if pending:
+                await asyncio.wait(pending)
+        except ConnectionError:
+            pass
+        finally:
+            for session in opened:
+                self._sessions.pop(session, None)
+            writer.close()
+
+    async def serve_unix(self, path):
+        return await asyncio.start_unix_server(self._serve_connection, path)
+
+    async def serve_tcp(self, host='127.0.0.1', port=0):
+        return await asyncio.start_server(self._serve_connection, host, port)
+
+class Client:
+    """
+    A blocking client of a LocalizationService; use one per thread.
+
+    Methods
+    -------
+    request(op, **fields): sends one request and returns its response,
+      raising ValueError if the service reports an error
+    decode(observations, marginals=False), open(lag=0),
+    update(session, observation), close(session), stats():
+      shorthands for the ops listed at the top of the module
+    """
+    def __init__(self, path=None, host='127.0.0.1', port=None):
+        if path is not None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(path)
+        else:
+            self._socket = socket.create_connection((host, port))
+        self._file = self._socket.makefile('rwb')
+        self._ids  = itertools.count()
+
+    def request(self, op, **fields):
+        request_id = next(self._ids)
+        fields.update(op=op, id=request_id)
+        self._file.write(json.dumps(fields).encode() + b'\n')
+        self._file.flush()
+        while True:
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError('the service closed the connection')
+            response = json.loads(line)
+            if response.get('id') == request_id:
+                break
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def decode(self, observations, marginals=False):
+        return self.request('decode', observations=observations,
+                            marginals=marginals)
+
+    def open(self, lag=0):
+        return self.request('open', lag=lag)['session']
+
+    def update(self, session, observation):
+        return self.request('update', session=session,
+                            observation=observation)
+
+    def close(self, session):
+        self.request('close', session=session)
+
+    def stats(self):
+        return self.request('stats')['stats']
+
+    def shutdown(self):
+        self._file.close()
+        self._socket.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run the localization service, or query it.')
+    parser.add_argument('command', choices=['serve', 'decode', 'stats'],
+                        help='serve, decode a trajectory file, or print the '
+                             'service statistics')
+    parser.add_argument('file', nargs='?',
+                        help='trajectory file to decode')
+    parser.add_argument('--socket', help='Unix socket path')
+    parser.add_argument('--port', type=int, default=8765,
+                        help='localhost TCP port, used without --socket '
+                             '(default: %(default)s)')
+    parser.add_argument('--batch-window', type=float, default=.005,
+                        help='seconds a decode waits for others to batch '
+                             'with (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        async def serve():
+            service = LocalizationService(batch_window=args.batch_window)
+            if args.socket is not None:
+                server = await service.serve_unix(args.socket)
+            else:
+                server = await service.serve_tcp('127.0.0.1', args.port)
+            print('serving on %s' % (args.socket or '127.0.0.1:%d' % args.port))
+            sys.stdout.flush()
+            async with server:
+                await server.serve_forever()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        return
+
+    client = Client(args.socket, port=args.port)
+    if args.command == 'decode':
+        if args.file is None:
+            parser.error('decode needs a trajectory file')
+        hidden_states, observations = rover.load_data(args.file)
+        response = client.decode(observations)
+        errors = sum(tuple(z) != state for z, state in
+                     zip(response['viterbi'], hidden_states))
+        print('log-likelihood %.4f, Viterbi error rate %.4f, %.2f ms'
+              % (response['log_likelihood'],
+                 errors / max(len(hidden_states), 1),
+                 response['latency_ms']))
+    else:
+        print(json.dumps(client.stats(), indent=2))
+    client.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import os
+import numpy as np
+import engine
+import rover
+import trajectory
+
+#-----------------------------------------------------------------------------
+# Synthetic trajectory generator.
+#
+# Trajectories are sampled from the model tables in ModelArrays. All
+# trajectories advance together, so every time step is one vectorized
+# categorical draw over the rows of the transition and emission matrices.
+
+def _cumulative_rows(matrix):
+    # padded row columns and cumulative row probabilities; the padding has
+    # cumulative probability 2 so that it is never picked
+    columns, values = matrix.padded_rows(fill_value=0.)
+    cumulative = np.cumsum(values, axis=1)
+    counts = np.diff(matrix.indptr)
+    padding = np.arange(values.shape[1]) >= counts[:, None]
+    cumulative[padding] = 2.
+    return columns, cumulative
+
+def _draw(columns, cumulative, rows, uniforms):
+    # for every row r in rows, the column whose cumulative probability
+    # interval holds the matching uniform draw
+    choice = (uniforms[:, None] >= cumulative[rows]).sum(axis=1)
+    choice = np.minimum(choice, (cumulative[rows] <= 1.5).sum(axis=1) - 1)
+    return columns[rows, choice]
+
+def sample(model, num_trajectories, num_time_steps, missing_rate=0.,
+           seed=None):
+    """
+    Inputs
+    ------
+    model: a ModelArrays
+    num_trajectories, num_time_steps: the shape of the sample
+    missing_rate: the probability that any one observation is missing
+    seed: seed of the random number generator
+
+    Output
+    ------
+    Two N x T arrays: the indices of the sampled hidden states, and the
+    indices of the sampled observations (engine.MISSING when missing)
+    """
+    rng = np.random.default_rng(seed)
+    transition_columns, transition_cumulative = \
+        _cumulative_rows(model.transitions)
+    emission_columns, emission_cumulative = _cumulative_rows(model.emissions)
+    prior_cumulative = np.cumsum(model.prior)
+
+    states = np.empty((num_trajectories, num_time_steps), dtype=np.int64)
+    if num_time_steps == 0:
+        return states, states.copy()
+    states[:, 0] = np.minimum(np.searchsorted(prior_cumulative,
+                                              rng.random(num_trajectories),
+                                              side='right'),
+                              model.num_states - 1)
+    for i in range(1, num_time_steps):
+        states[:, i] = _draw(transition_columns, transition_cumulative,
+                             states[:, i-1], rng.random(num_trajectories))
+
+    flat_states  = states.ravel()
+    observations = _draw(emission_columns, emission_cumulative, flat_states,
+                         rng.random(len(flat_states)))
+    observations = observations.reshape(states.shape)
+    missing = rng.random(states.shape) < missing_rate
+    observations[missing] = engine.MISSING
+    return states, observations
+
+def to_trajectory(model, states, observations):
+    # a trajectory.Trajectory for one row of the output of sample(); the
+    # coordinate tables are cached on the model, so this is pure indexing
+    xs, ys = model.positions()
+    observed_xs, observed_ys = model.observed_positions()
+    missing = observations == engine.MISSING
+    seen    = np.where(missing, 0, observations)
+    return trajectory.Trajectory(
+        xs[states].astype(np.int16), ys[states].astype(np.int16),
+        model.action_codes()[states].astype(np.uint8),
+        np.where(missing, 0, observed_xs[seen]).astype(np.int16),
+        np.where(missing, 0, observed_ys[seen]).astype(np.int16),
+        missing)
+
+def save_text(filename, model, states, observations):
+    # writes one row of the output of sample() in the format read by
+    # rover.load_data()
+    with open(filename, 'w') as f:
+        for z, k in zip(states.tolist(), observations.tolist()):
+            x, y, action = model.hidden_states[z]
+            if k == engine.MISSING:
+                f.write('%d %d %s missing\n' % (x, y, action))
+            else:
+                f.write('%d %d %s %d %d\n' % ((x, y, action) +
+                                              model.observed_states[k]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Sample synthetic rover trajectories.')
+    parser.add_argument('output_dir')
+    parser.add_argument('-n', '--trajectories', type=int, default=10)
+    parser.add_argument('-t', '--steps', type=int, default=100)
+    parser.add_argument('--missing-rate', type=float, default=0.)
+    parser.add_argument('--grid', default='%dx%d' % (rover.GRID_WIDTH,
+                                                     rover.GRID_HEIGHT),
+                        help='grid size WxH (default: %(default)s)')
+    parser.add_argument('--format', choices=['text', 'binary'],
+                        default='text')
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    width, height = [int(part) for part in args.grid.lower().split('x')]
+    model = engine.build_grid_model_arrays(rover.GridModel(width, height))
+    states, observations = sample(model, args.trajectories, args.steps,
+                                  args.missing_rate, args.seed)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for n in range(args.trajectories):
+        if args.format == 'text':
+            save_text(os.path.join(args.output_dir, 'trajectory_%06d.txt' % n),
+                      model, states[n], observations[n])
+        else:
+            trajectory.save_binary(
+                os.path.join(args.output_dir, 'trajectory_%06d.bin' % n),
+                to_trajectory(model, states[n], observations[n]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+import sys
+import numpy as np
+import engine
+import rover
+
+#-----------------------------------------------------------------------------
+# Compact binary trajectory format.
+#
+# A file starts with a 16-byte header (the magic bytes below followed by the
+# number of time steps as a little-endian uint64) and then holds one column
+# per field, each starting on an 8-byte boundary:
+#
+#   x, y                    int16   hidden position
+#   action                  uint8   index of the hidden action in
+#                                   rover.ACTIONS
+#   observed_x, observed_y  int16   observed position (0 when missing)
+#   missing                 bits    1 where the observation is missing,
+#                                   packed 8 steps per byte
+#
+# Loading memory-maps the file, so the columns are read lazily and without
+# copying.
+
+MAGIC = b'RVTRJ1\x00\x00'
+
+_COLUMNS = [('x', '<i2'), ('y', '<i2'), ('action', 'u1'),
+            ('observed_x', '<i2'), ('observed_y', '<i2'), ('missing', 'u1')]
+
+def _column_layout(num_time_steps):
+    # byte offset and length of every column
+    layout = []
+    offset = len(MAGIC) + 8
+    for name, dtype in _COLUMNS:
+        if name == 'missing':
+            length = (num_time_steps + 7) // 8
+        else:
+            length = num_time_steps
+        layout.append((name, dtype, offset, length))
+        offset += length * np.dtype(dtype).itemsize
+        offset += -offset % 8
+    return layout
+
+class Trajectory:
+    """
+    A trajectory held as columns of arrays.
+
+    Attributes
+    ----------
+    x, y, action, observed_x, observed_y: the columns described above
+    missing: boolean vector, True where the observation is missing
+
+    Methods
+    -------
+    hidden_states(), observations():
+      return the lists that rover.load_data() returns for the trajectory
+    state_indices(model), observation_indices(model):
+      return the hidden states and observations as index vectors of a
+      ModelArrays, ready to be handed to the functions in engine.py
+    """
+    def __init__(self, x, y, action, observed_x, observed_y, missing):
+        self.x          = x
+        self.y          = y
+        self.action     = action
+        self.observed_x = observed_x
+        self.observed_y = observed_y
+        self.missing    = missing
+
+    def __len__(self):
+        return len(self.x)
+
+    def hidden_states(self):
+        return [(x, y, rover.ACTIONS[a]) for x, y, a in
+                zip(self.x.tolist(), self.y.tolist(), self.action.tolist())]
+
+    def observations(self):
+        return [None if m else (x, y) for x, y, m in
+                zip(self.observed_x.tolist(), self.observed_y.tolist(),
+                    self.missing.tolist())]
+
+    def state_indices(self, model):
+        lookup = model.state_lookup()
+        if np.any((self.x < 0) | (self.x >= lookup.shape[0]) |
+                  (self.y < 0) | (self.y >= lookup.shape[1]) |
+                  (self.action >= lookup.shape[2])):
+            raise KeyError('trajectory holds hidden states that are not in '
+                           'the model')
+        indices = lookup[self.x, self.y, self.action]
+        if np.any(indices < 0):
+            raise KeyError('trajectory holds hidden states that are not in '
+                           'the model')
+        return indices
+
+    def observation_indices(self, model):
+        lookup = model.observation_lookup()
+        x = np.where(self.missing, 0, self.observed_x)
+        y = np.where(self.missing, 0, self.observed_y)
+        if np.any((x < 0) | (x >= lookup.shape[0]) |
+                  (y < 0) | (y >= lookup.shape[1])):
+            raise KeyError('trajectory holds observations that are not in '
+                           'the model')
+        indices = np.where(self.missing, engine.MISSING, lookup[x, y])
+        if np.any((indices == engine.MISSING) & ~self.missing):
+            raise KeyError('trajectory holds observations that are not in '
+                           'the model')
+        return indices
+
+def from_lists(hidden_states, observations):
+    # builds a Trajectory from the lists that rover.load_data() returns
+    missing = np.array([o is None for o in observations], dtype=bool)
+    return Trajectory(
+        np.array([z[0] for z in hidden_states], dtype=np.int16),
+        np.array([z[1] for z in hidden_states], dtype=np.int16),
+        np.array([rover.ACTIONS.index(z[2]) for z in hidden_states], dtype=np.uint8),
+        np.array([0 if o is None else o[0] for o in observations],
+                 dtype=np.int16),
+        np.array([0 if o is None else o[1] for o in observations],
+                 dtype=np.int16),
+        missing)
+
+def save_binary(filename, trajectory):
+    num_time_steps = len(trajectory)
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(num_time_steps).astype('<u8').tobytes())
+        for name, dtype, offset, length in _column_layout(num_time_steps):
+            column = getattr(trajectory, name)
+            if name == 'missing':
+                column = np.packbits(np.asarray(column, dtype=bool))
+            f.write(b'\x00' * (offset - f.tell()))
+            f.write(np.ascontiguousarray(column, dtype=dtype).tobytes())
+
+def load_binary(filename):
+    # memory-maps a binary trajectory file
+    with open(filename, 'rb') as f:
+        header = f.read(len(MAGIC) + 8)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not a binary trajectory file' % filename)
+    num_time_steps = int(np.frombuffer(header[len(MAGIC):], dtype='<u8')[0])
+
+    columns = {}
+    for name, dtype, offset, length in _column_layout(num_time_steps):
+        if length == 0:
+            columns[name] = np.zeros(0, dtype=dtype)
+        else:
+            columns[name] = np.memmap(filename, dtype=dtype, mode='r',
+                                      offset=offset, shape=(length,))
+    columns['missing'] = np.unpackbits(columns['missing'],
+                                       count=num_time_steps).view(bool)
+    return Trajectory(**columns)
+
+def convert_text_to_binary(text_filename, binary_filename):
+    hidden_states, observations = rover.load_data(text_filename)
+    save_binary(binary_filename, from_lists(hidden_states, observations))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python trajectory.py <text file> <binary file>')
+    convert_text_to_binary(sys.argv[1], sys.argv[2])